@@ -29,6 +29,10 @@ from aws_cdk import (
     aws_lambda as _lambda,
     aws_iam as iam,
     aws_s3_notifications as s3n,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_events as events,
+    aws_events_targets as targets,
     CfnOutput
 )
 from constructs import Construct
@@ -47,6 +51,7 @@ class GeoReferencePipelineStack(Stack):
         # Lambda function names
         compression_fn_name = self.node.try_get_context("compression_function_name") or "GeoCompressionLambda"
         analysis_fn_name = self.node.try_get_context("analysis_function_name") or "GeoAnalysisLambda"
+        compaction_fn_name = self.node.try_get_context("compaction_function_name") or "GeoCompactionLambda"
 
         # Layer names
         compression_layer_name = self.node.try_get_context("compression_layer_name") or "GeoCompressionLayer"
@@ -55,18 +60,51 @@ class GeoReferencePipelineStack(Stack):
         # GitHub
         github_token = self.node.try_get_context("github_token") or "YOUR_GITHUB_TOKEN_HERE"
         github_repo_name = self.node.try_get_context("github_repo_name") or "water_resources_geojson"
+        # Empty means the owner of github_token
+        github_repo_owner = self.node.try_get_context("github_repo_owner") or ""
 
         # Bedrock
         bedrock_model_id = self.node.try_get_context("bedrock_model_id") or "anthropic.claude-3-5"
         bedrock_region = self.node.try_get_context("bedrock_region") or "us-west-2"
 
+        def context_int(key, default):
+            # For settings where 0 is meaningful, which `int(ctx or default)` would drop
+            value = self.node.try_get_context(key)
+            return default if value is None else int(value)
+
         # Additional settings (Lambda memory, ephemeral storage, etc.)
         max_lambda_mem = int(self.node.try_get_context("max_lambda_memory_mb") or 1024)
+        # Per-function memory (CPU scales with memory); each falls back to max_lambda_memory_mb.
+        # Tune these with AWS Lambda Power Tuning, see the README.
+        compression_mem = int(self.node.try_get_context("compression_memory_mb") or max_lambda_mem)
+        analysis_mem = int(self.node.try_get_context("analysis_memory_mb") or max_lambda_mem)
+        compaction_mem = int(self.node.try_get_context("compaction_memory_mb") or max_lambda_mem)
         max_lambda_timeout = int(self.node.try_get_context("max_lambda_timeout_minutes") or 15)
         max_lambda_storage = int(self.node.try_get_context("max_lambda_ephemeral_storage_mb") or 1024)
         
         # Compression-specific
         compression_target_mb = int(self.node.try_get_context("compression_target_mb") or 3)
+        # Parallel worker processes per batch (0 = one per vCPU, 1 = single process)
+        compression_worker_processes = context_int("compression_worker_processes", 1)
+        # Format of compressed images ("PNG" or "WEBP")
+        compression_output_format = (self.node.try_get_context("compression_output_format") or "PNG").upper()
+        if compression_output_format not in ("PNG", "WEBP"):
+            raise ValueError(f"compression_output_format must be PNG or WEBP, got {compression_output_format!r}")
+
+        # Provisioned concurrency range for the Analysis Lambda's "live" alias (min 0 turns it off)
+        analysis_provisioned_min = context_int("analysis_provisioned_concurrency_min", 1)
+        analysis_provisioned_max = int(self.node.try_get_context("analysis_provisioned_concurrency_max") or 10)
+
+        # How long GeoLocate / Nominatim lookups stay in the S3 geocode cache
+        geocode_cache_ttl_days = int(self.node.try_get_context("geocode_cache_ttl_days") or 30)
+
+        # SQS batching between S3 events and the Lambdas
+        sqs_batch_size = int(self.node.try_get_context("sqs_batch_size") or 10)
+        sqs_max_batching_window_seconds = context_int("sqs_max_batching_window_seconds", 30)
+        sqs_max_receive_count = int(self.node.try_get_context("sqs_max_receive_count") or 3)
+
+        # Compaction-specific (how often analysis shards are merged into the CSV)
+        compaction_schedule_minutes = int(self.node.try_get_context("compaction_schedule_minutes") or 15)
 
         # Optionally, if you want to pass the prompt file name as an env variable
         prompt_file_name = self.node.try_get_context("prompt_file_name") or "prompt.py"
@@ -80,24 +118,61 @@ class GeoReferencePipelineStack(Stack):
             bucket_name=bucket_name,
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
             removal_policy=RemovalPolicy.DESTROY,
-            auto_delete_objects=True
+            auto_delete_objects=True,
+            lifecycle_rules=[
+                s3.LifecycleRule(prefix="cache/", expiration=Duration.days(geocode_cache_ttl_days))
+            ]
         )
 
-        # Create subfolders by deploying placeholder files (optional, but nice for initial structure)
+        # Create subfolders by deploying placeholder files (optional, but nice for initial structure).
+        # A single deployment keeps this to one custom resource; prune is off so
+        # it never deletes pipeline objects outside the placeholders.
         folders = ["raw/", "compressed/", "error/", "analysis/"]
-        for folder in folders:
-            s3_deployment.BucketDeployment(
-                self,
-                f"Create{folder.capitalize().replace('/', '')}Folder",
-                destination_bucket=data_bucket,
-                destination_key_prefix=folder,
-                sources=[s3_deployment.Source.data("placeholder.txt", "Placeholder")],
-                retain_on_delete=False
-            )
+        s3_deployment.BucketDeployment(
+            self,
+            "CreateFolders",
+            destination_bucket=data_bucket,
+            sources=[s3_deployment.Source.data(f"{folder}placeholder.txt", "Placeholder") for folder in folders],
+            prune=False,
+            retain_on_delete=False
+        )
 
         # ----------------------------------------------------
-        # 3. Create Lambda Layers (from local .zip files)
+        # 3. Create SQS queues (S3 events are batched through SQS)
         # ----------------------------------------------------
+        # Visibility timeout must comfortably exceed the Lambda timeout so a
+        # batch still being processed is not redelivered to another instance.
+        queue_visibility_timeout = Duration.minutes(max_lambda_timeout * 6)
+
+        raw_dlq = sqs.Queue(
+            self,
+            "RawDeadLetterQueue",
+            retention_period=Duration.days(14)
+        )
+        raw_queue = sqs.Queue(
+            self,
+            "RawQueue",
+            visibility_timeout=queue_visibility_timeout,
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=sqs_max_receive_count, queue=raw_dlq)
+        )
+
+        compressed_dlq = sqs.Queue(
+            self,
+            "CompressedDeadLetterQueue",
+            retention_period=Duration.days(14)
+        )
+        compressed_queue = sqs.Queue(
+            self,
+            "CompressedQueue",
+            visibility_timeout=queue_visibility_timeout,
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=sqs_max_receive_count, queue=compressed_dlq)
+        )
+
+        # ----------------------------------------------------
+        # 4. Create Lambda Layers (from local .zip files)
+        # ----------------------------------------------------
+        # The layers are built for arm64 (Graviton); see "Building the Lambda
+        # Layers" in the README before changing the functions' architecture.
     
         compression_layer = _lambda.LayerVersion(
             self,
@@ -105,7 +180,8 @@ class GeoReferencePipelineStack(Stack):
             layer_version_name=compression_layer_name,
             description="Layer for image compression dependencies",
             code=_lambda.Code.from_asset("geo_reference_pipeline/layers/layer1.zip"),
-            compatible_runtimes=[_lambda.Runtime.PYTHON_3_13]
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_13],
+            compatible_architectures=[_lambda.Architecture.ARM_64]
         )
 
         analysis_layer = _lambda.LayerVersion(
@@ -114,110 +190,253 @@ class GeoReferencePipelineStack(Stack):
             layer_version_name=analysis_layer_name,
             description="Layer for analysis dependencies",
             code=_lambda.Code.from_asset("geo_reference_pipeline/layers/layer2.zip"),
-            compatible_runtimes=[_lambda.Runtime.PYTHON_3_13]
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_13],
+            compatible_architectures=[_lambda.Architecture.ARM_64]
         )
 
         # ----------------------------------------------------
-        # 4. IAM Role for Lambdas & Policies
+        # 5. IAM Roles for Lambdas & Policies
         # ----------------------------------------------------
-        lambda_role = iam.Role(
-            self,
-            "LambdaExecutionRole",
-            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com")
+        # One role per function, each limited to the S3 prefixes it touches.
+        # SQS and X-Ray permissions are added by the event sources / tracing.
+        bucket_objects = f"{data_bucket.bucket_arn}/"
+
+        def lambda_execution_role(construct_id):
+            role = iam.Role(
+                self,
+                construct_id,
+                assumed_by=iam.ServicePrincipal("lambda.amazonaws.com")
+            )
+            # Basic Execution (CloudWatch Logs, etc.)
+            role.add_managed_policy(
+                iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")
+            )
+            return role
+
+        # Compression: read raw/, write compressed/ and error/
+        compression_role = lambda_execution_role("CompressionExecutionRole")
+        compression_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject"],
+                resources=[f"{bucket_objects}raw/*"]
+            )
         )
-        
-        # Basic Execution (CloudWatch Logs, etc.)
-        lambda_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")
+        compression_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject"],
+                resources=[f"{bucket_objects}compressed/*", f"{bucket_objects}error/*"]
+            )
+        )
+        # Lets a failed multipart upload of a large output clean up its parts
+        compression_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:AbortMultipartUpload"],
+                resources=[f"{bucket_objects}compressed/*"]
+            )
         )
 
-        # S3 access
-        lambda_role.add_to_policy(
+        # Analysis: read compressed/, write shards and error/, read/write the geocode cache.
+        # ListBucket makes missing cache entries come back as NoSuchKey rather than AccessDenied.
+        analysis_role = lambda_execution_role("AnalysisExecutionRole")
+        analysis_role.add_to_policy(
             iam.PolicyStatement(
-                actions=["s3:GetObject", "s3:PutObject", "s3:ListBucket", "s3:DeleteObject"],
-                resources=[data_bucket.bucket_arn, f"{data_bucket.bucket_arn}/*"]
+                actions=["s3:ListBucket"],
+                resources=[data_bucket.bucket_arn]
+            )
+        )
+        analysis_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject"],
+                resources=[f"{bucket_objects}compressed/*", f"{bucket_objects}cache/*"]
+            )
+        )
+        analysis_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject"],
+                resources=[
+                    f"{bucket_objects}analysis/shards/*",
+                    f"{bucket_objects}error/*",
+                    f"{bucket_objects}cache/*"
+                ]
             )
         )
 
         # Bedrock permissions (to invoke model)
-        lambda_role.add_to_policy(
+        analysis_role.add_to_policy(
             iam.PolicyStatement(
                 actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
-                resources=["*"]  # Or specify your bedrock resources if you prefer
+                resources=[
+                    f"arn:{self.partition}:bedrock:*::foundation-model/*",
+                    f"arn:{self.partition}:bedrock:*:{self.account}:inference-profile/*"
+                ]
+            )
+        )
+
+        # Compaction: list and delete shards, read/write the consolidated CSV
+        compaction_role = lambda_execution_role("CompactionExecutionRole")
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:ListBucket"],
+                resources=[data_bucket.bucket_arn]
+            )
+        )
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject", "s3:PutObject"],
+                resources=[f"{bucket_objects}analysis/*"]
+            )
+        )
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:DeleteObject"],
+                resources=[f"{bucket_objects}analysis/shards/*"]
             )
         )
 
         # (Optionally) VPC, Secrets, or other permissions as needed for your environment.
 
         # ----------------------------------------------------
-        # 5. Define the Compression Lambda (trigger on raw/)
+        # 6. Define the Compression Lambda (trigger on raw/)
         # ----------------------------------------------------
         compression_lambda = _lambda.Function(
             self,
             "CompressionLambda",
             function_name=compression_fn_name,
             runtime=_lambda.Runtime.PYTHON_3_13,
-            role=lambda_role,
+            architecture=_lambda.Architecture.ARM_64,
+            role=compression_role,
+            tracing=_lambda.Tracing.ACTIVE,
             handler="compression_handler.lambda_handler",
             code=_lambda.Code.from_asset("geo_reference_pipeline/lambda_functions/compress_lambda"),
-            memory_size=max_lambda_mem,
+            memory_size=compression_mem,
             timeout=Duration.minutes(max_lambda_timeout),
             ephemeral_storage_size=Size.mebibytes(max_lambda_storage),
             layers=[compression_layer],
             environment={
                 "BUCKET_NAME": data_bucket.bucket_name,
                 "COMPRESSION_TARGET_MB": str(compression_target_mb),
+                "COMPRESSION_WORKER_PROCESSES": str(compression_worker_processes),
+                "OUTPUT_FORMAT": compression_output_format,
                 "ERROR_FOLDER": "error",
                 "COMPRESSED_FOLDER": "compressed"
             }
         )
 
-        # Create S3 notification for raw/ folder
-        notification_raw = s3n.LambdaDestination(compression_lambda)
+        # Create S3 notification for raw/ folder, batched through SQS
+        notification_raw = s3n.SqsDestination(raw_queue)
         data_bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
             notification_raw,
             s3.NotificationKeyFilter(prefix="raw/")
         )
+        compression_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                raw_queue,
+                batch_size=sqs_batch_size,
+                max_batching_window=Duration.seconds(sqs_max_batching_window_seconds),
+                report_batch_item_failures=True
+            )
+        )
 
         # ----------------------------------------------------
-        # 6. Define the Analysis Lambda (trigger on compressed/)
+        # 7. Define the Analysis Lambda (trigger on compressed/)
         # ----------------------------------------------------
         analysis_lambda = _lambda.Function(
             self,
             "AnalysisLambda",
             function_name=analysis_fn_name,
             runtime=_lambda.Runtime.PYTHON_3_13,
-            role=lambda_role,
+            architecture=_lambda.Architecture.ARM_64,
+            role=analysis_role,
+            tracing=_lambda.Tracing.ACTIVE,
             handler="analysis_handler.lambda_handler",
             code=_lambda.Code.from_asset("geo_reference_pipeline/lambda_functions/analysis_lambda"),
-            memory_size=max_lambda_mem,
+            memory_size=analysis_mem,
             timeout=Duration.minutes(max_lambda_timeout),
-            ephemeral_storage_size=Size.mebibytes(max_lambda_storage),
+            # Images are read into memory, nothing is written to /tmp
+            ephemeral_storage_size=Size.mebibytes(512),
             layers=[analysis_layer],
             environment={
                 "BUCKET_NAME": data_bucket.bucket_name,
                 "ERROR_FOLDER": "error",
                 "ANALYSIS_FOLDER": "analysis",
+                "CACHE_FOLDER": "cache",
                 "GITHUB_TOKEN": github_token,
                 "GITHUB_REPO_NAME": github_repo_name,
+                "GITHUB_REPO_OWNER": github_repo_owner,
                 "BEDROCK_MODEL_ID": bedrock_model_id,
                 "BEDROCK_REGION": bedrock_region,
                 "PROMPT_FILE_NAME": prompt_file_name
             }
         )
 
-        # Create S3 notification for compressed/ folder
-        notification_compressed = s3n.LambdaDestination(analysis_lambda)
+        # Keep warm instances behind a "live" alias so bursts of uploads do not
+        # pay the analysis dependencies' cold-start import cost
+        analysis_alias = _lambda.Alias(
+            self,
+            "AnalysisLiveAlias",
+            alias_name="live",
+            version=analysis_lambda.current_version,
+            provisioned_concurrent_executions=analysis_provisioned_min or None
+        )
+        if analysis_provisioned_min:
+            analysis_alias.add_auto_scaling(
+                min_capacity=analysis_provisioned_min,
+                max_capacity=analysis_provisioned_max
+            ).scale_on_utilization(utilization_target=0.7)
+
+        # Create S3 notification for compressed/ folder, batched through SQS
+        notification_compressed = s3n.SqsDestination(compressed_queue)
         data_bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
             notification_compressed,
             s3.NotificationKeyFilter(prefix="compressed/")
         )
+        analysis_alias.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                compressed_queue,
+                batch_size=sqs_batch_size,
+                max_batching_window=Duration.seconds(sqs_max_batching_window_seconds),
+                report_batch_item_failures=True
+            )
+        )
+
+        # ----------------------------------------------------
+        # 8. Define the Compaction Lambda (scheduled)
+        # ----------------------------------------------------
+        compaction_lambda = _lambda.Function(
+            self,
+            "CompactionLambda",
+            function_name=compaction_fn_name,
+            runtime=_lambda.Runtime.PYTHON_3_13,
+            architecture=_lambda.Architecture.ARM_64,
+            role=compaction_role,
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="compaction_handler.lambda_handler",
+            code=_lambda.Code.from_asset("geo_reference_pipeline/lambda_functions/compaction_lambda"),
+            memory_size=compaction_mem,
+            timeout=Duration.minutes(max_lambda_timeout),
+            # A single writer owns the consolidated CSV
+            reserved_concurrent_executions=1,
+            environment={
+                "BUCKET_NAME": data_bucket.bucket_name,
+                "ANALYSIS_FOLDER": "analysis"
+            }
+        )
+
+        events.Rule(
+            self,
+            "CompactionSchedule",
+            schedule=events.Schedule.rate(Duration.minutes(compaction_schedule_minutes)),
+            targets=[targets.LambdaFunction(compaction_lambda)]
+        )
 
         # ----------------------------------------------------
-        # 7. Outputs
+        # 9. Outputs
         # ----------------------------------------------------
         CfnOutput(self, "BucketName", value=data_bucket.bucket_name)
         CfnOutput(self, "CompressionLambdaName", value=compression_lambda.function_name)
         CfnOutput(self, "AnalysisLambdaName", value=analysis_lambda.function_name)
+        CfnOutput(self, "CompactionLambdaName", value=compaction_lambda.function_name)
+        CfnOutput(self, "RawDeadLetterQueueUrl", value=raw_dlq.queue_url)
+        CfnOutput(self, "CompressedDeadLetterQueueUrl", value=compressed_dlq.queue_url)
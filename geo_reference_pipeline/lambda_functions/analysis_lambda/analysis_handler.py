@@ -1,23 +1,115 @@
 import os
-import io
 import json
+import hashlib
+import html
+import time
+import functools
 import base64
 import boto3
+import threading
 import requests
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, unquote_plus
 import geojson
 from geopy.geocoders import Nominatim
-from github import Github
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from xml.etree import ElementTree
-
-# Global clients
-s3_client = boto3.client("s3")
-
-# If you need region-specific clients for Bedrock:
-#   bedrock_region = os.environ.get("BEDROCK_REGION", "us-west-2")
-#   bedrock_client = boto3.client("bedrock-runtime", region_name=bedrock_region)
-# For simplicity, let's create the client lazily after reading env variables in the handler.
+from lxml import etree
+from aws_xray_sdk.core import patch_all
+
+# Record boto3 (S3, Bedrock) and requests (GeoLocate, GitHub) calls as X-Ray subsegments
+patch_all()
+
+# Configuration is fixed for the lifetime of the Lambda container, so it is
+# read once at init rather than on every invocation.
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+ERROR_FOLDER = os.environ.get("ERROR_FOLDER", "error")
+ANALYSIS_FOLDER = os.environ.get("ANALYSIS_FOLDER", "analysis")
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", "cache")
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_REPO_NAME = os.environ.get("GITHUB_REPO_NAME", "water_resources_geojson")
+GITHUB_REPO_OWNER = os.environ.get("GITHUB_REPO_OWNER", "")
+GITHUB_API_URL = "https://api.github.com"
+BEDROCK_MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "anthropic.claude-3-5")
+BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "us-west-2")
+PROMPT_FILE_NAME = os.environ.get("PROMPT_FILE_NAME", "prompt.py")
+
+METRICS_NAMESPACE = "GeoReferencePipeline"
+
+# Marks where the base64 image goes in the cached Bedrock request body
+IMAGE_DATA_PLACEHOLDER = "@@IMAGE_DATA@@"
+# Media type sent to Bedrock for each compressed image extension
+IMAGE_MEDIA_TYPES = {".png": "image/png", ".webp": "image/webp", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+
+# Township and geocoding lookups for one map run concurrently
+GEOCODE_MAX_WORKERS = 16
+# Error codes that are written to 'error/' instead of being retried through SQS
+TERMINAL_ERROR_CODES = {"NoSuchKey", "ValidationException", "AccessDenied", "AccessDeniedException"}
+
+# Global clients, reused across warm invocations
+# Cache reads/writes run from every geocoding thread, plus the image prefetch
+# and the handler thread, more than botocore's default pool of 10 connections
+s3_client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=GEOCODE_MAX_WORKERS + 4,
+        retries={"mode": "adaptive", "max_attempts": 5},
+        tcp_keepalive=True
+    )
+)
+
+bedrock_client = boto3.client(
+    "bedrock-runtime",
+    region_name=BEDROCK_REGION,
+    config=Config(tcp_keepalive=True, retries={"mode": "adaptive", "max_attempts": 3})
+)
+
+# GitHub REST API session; the token is sent on every request
+github_session = requests.Session()
+github_session.headers.update({
+    "Authorization": f"Bearer {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28"
+})
+
+# Pooled HTTP session for the GeoLocate SOAP service, sized for the lookup workers
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=GEOCODE_MAX_WORKERS, pool_maxsize=GEOCODE_MAX_WORKERS)
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+geocode_lock = threading.Lock()
+
+# GeoLocate SOAP responses are parsed with lxml; the XPath is compiled once
+# per container and picks the first ResultSet in document order.
+GEOLOCATE_NAMESPACES = {'ns': 'http://geo-locate.org/webservices/'}
+first_result_set = etree.XPath('(//ns:ResultSet)[1]', namespaces=GEOLOCATE_NAMESPACES)
+soap_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+# Georef2 request envelope, built once; the NUL-delimited markers are replaced
+# with the XML-escaped country, state and locality for each call.
+GEOLOCATE_SOAP_TEMPLATE = b'''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
+               xmlns:xsd="http://www.w3.org/2001/XMLSchema" 
+               xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <Georef2 xmlns="http://geo-locate.org/webservices/">
+      <Country>\x00C\x00</Country>
+      <State>\x00S\x00</State>
+      <County></County>
+      <LocalityString>\x00L\x00</LocalityString>
+      <HwyX>true</HwyX>
+      <FindWaterbody>true</FindWaterbody>
+      <RestrictToLowestAdm>false</RestrictToLowestAdm>
+      <doUncert>true</doUncert>
+      <doPoly>true</doPoly>
+      <displacePoly>false</displacePoly>
+      <polyAsLinkID>false</polyAsLinkID>
+      <LanguageKey>0</LanguageKey>
+    </Georef2>
+  </soap:Body>
+</soap:Envelope>'''
 
 geolocator = Nominatim(user_agent="myGeocoder",timeout=10)
 # Colorado bounding coordinates (WGS84)
@@ -31,10 +123,66 @@ geolocator = Nominatim(user_agent="myGeocoder",timeout=10)
 # )
 
 
-def invoke_bedrock_model_claude_multimodal(bedrock_client, content_image_b64, text_prompt, model_id, max_length=4096):
+# Attempt to load the prompt from a local file in the Lambda package
+# (You might have a better approach, e.g., SSM Parameter, or stored in S3)
+# from .prompt import PROMPT
+PROMPT_TEXT = """Analyze the uploaded map image thoroughly to identify all relevant details. Then, return a strictly formatted JSON object with the **exact** structure and keys below (and nothing else):
+
+{
+  "map_description": "string",
+  "township_range": [
+    // An array of valid township-range strings. A township-range string is considered valid only if it contains:
+    //   1. A Township value in the format "T<number>N" or "T<number>S"
+    //   2. A Range value in the format "R<number>E" or "R<number>W"
+    //   3. Ideally, a Section value formatted as "Section <number>"
+    // For example: "T1N R1E Section 1" or "T2S R3W Section 15".
+    // If you cannot find any complete township-range information, return an empty array.
+  ],
+  "county": "string", 
+    // If multiple counties apply, join them into one string separated by a semicolon and a space (e.g., "Teller County (Colo.); El Paso County (Colo.)").
+  "water_resources": [
+    // An array with as many water resources as you can identify from the map.
+    // For each water resource, include the following keys:
+    {
+      "name": "string",
+      "description": "string",
+      "feature_type": "reservoir, dam, river, lake, creek, etc.",
+      "township_range": "string" 
+        // If you can identify a valid township-range (i.e. including both T and R values, and a Section number), put it here.
+        // Otherwise, leave this field as an empty string "".
+    },
+    ...
+  ]
+}
+
+Instructions and notes:
+1. **map_description**: Provide a comprehensive description of the map, including its features, landmarks, and any notable context.
+2. **township_range**: Only include strings that contain both a valid Township and Range value (e.g., "T8N R70W") along with a Section number (e.g., "Section 15"). Do not include partial entries like "T8N" alone.
+3. **county**: Clearly specify the county (or counties) where the map is located. If more than one county is relevant, separate them using a semicolon and a space.
+4. **water_resources**:
+   - Identify every water resource visible on the map.
+   - For each, include "name", "description", and "feature_type".
+   - If the water resource has a visible township-range that is complete (including T, R), include it in the "township_range" field; if not, use an empty string.
+5. Return **only** valid JSON without any extra commentary, explanations, or text outside of the JSON object.
+"""
+# try:
+#     with open(os.path.join(os.path.dirname(__file__), PROMPT_FILE_NAME), "r") as f:
+#         PROMPT_TEXT = f.read()
+# except Exception:
+#     # fallback to an inline prompt if needed
+#     PROMPT_TEXT = """
+#     Analyze the uploaded map image thoroughly...
+#     ...
+#     (Your fallback prompt here)
+#     """
+
+
+@functools.lru_cache(maxsize=8)
+def bedrock_request_template(text_prompt, max_length, media_type="image/png"):
     """
-    Sends an image (base64-encoded) plus a text prompt to Claude via Bedrock.
-    Returns the text response.
+    Builds the Claude request body once per (prompt, max_tokens, media type) and returns it
+    as (prefix, suffix) bytes around the base64 image data, so each call only
+    concatenates the image instead of re-serializing the whole request.
     """
     messages = [
         {
@@ -44,8 +192,8 @@ def invoke_bedrock_model_claude_multimodal(bedrock_client, content_image_b64, te
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": content_image_b64
+                        "media_type": media_type,
+                        "data": IMAGE_DATA_PLACEHOLDER
                     }
                 },
                 {
@@ -62,457 +210,577 @@ def invoke_bedrock_model_claude_multimodal(bedrock_client, content_image_b64, te
         "temperature": 0.5,
         "messages": messages
     })
+    prefix, suffix = request_body.split(IMAGE_DATA_PLACEHOLDER, 1)
+    return prefix.encode("utf-8"), suffix.encode("utf-8")
+
+def invoke_bedrock_model_claude_multimodal(bedrock_client, content_image_b64, text_prompt, model_id, max_length=4096, media_type="image/png"):
+    """
+    Sends an image (base64-encoded bytes) plus a text prompt to Claude via Bedrock,
+    streaming the response. Returns the text response.
+    """
+    prefix, suffix = bedrock_request_template(text_prompt, max_length, media_type)
+    # Base64 output needs no JSON escaping, so it can be spliced in as-is
+    request_body = prefix + content_image_b64 + suffix
 
     try:
-        response = bedrock_client.invoke_model(
+        response = bedrock_client.invoke_model_with_response_stream(
             modelId=model_id,
             body=request_body
         )
-        model_response = json.loads(response["body"].read())
-        response_text = model_response["content"][0]["text"]
-        return response_text.strip()
+        # Each stream event is its own JSON document; collect the text deltas
+        text_parts = []
+        for stream_event in response["body"]:
+            chunk = stream_event.get("chunk")
+            if not chunk:
+                continue
+            payload = json.loads(chunk["bytes"])
+            if payload.get("type") == "content_block_delta" and payload["delta"].get("type") == "text_delta":
+                text_parts.append(payload["delta"]["text"])
+        return "".join(text_parts).strip()
     except (ClientError, Exception) as e:
         print(f"ERROR: Could not invoke '{model_id}' via Bedrock. Reason: {e}")
         raise
 
-def get_coordinates_from_township(township_str, country="United States of America", state="Colorado"):
+def extract_json(text):
     """
-    Calls a SOAP endpoint to convert a township-range string (which must include a section) into lat/lon.
+    Returns the first balanced {...} object in the model response, ignoring
+    any prose Claude adds before or after it. Braces inside JSON strings are
+    skipped. If the object is never closed the remainder is returned so
+    json.loads reports the real error.
     """
-    soap_request = f'''<?xml version="1.0" encoding="utf-8"?>
-<soap:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-               xmlns:xsd="http://www.w3.org/2001/XMLSchema" 
-               xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
-  <soap:Body>
-    <Georef2 xmlns="http://geo-locate.org/webservices/">
-      <Country>{country}</Country>
-      <State>{state}</State>
-      <County></County>
-      <LocalityString>{township_str}</LocalityString>
-      <HwyX>true</HwyX>
-      <FindWaterbody>true</FindWaterbody>
-      <RestrictToLowestAdm>false</RestrictToLowestAdm>
-      <doUncert>true</doUncert>
-      <doPoly>true</doPoly>
-      <displacePoly>false</displacePoly>
-      <polyAsLinkID>false</polyAsLinkID>
-      <LanguageKey>0</LanguageKey>
-    </Georef2>
-  </soap:Body>
-</soap:Envelope>'''
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("No JSON object found in model response.")
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+def emit_metric(name, value=1, **properties):
+    """
+    Prints a CloudWatch Embedded Metric Format record; Lambda's log ingestion
+    turns it into a metric without any extra API calls.
+    """
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [[]],
+                "Metrics": [{"Name": name, "Unit": "Count"}]
+            }]
+        },
+        name: value,
+        **properties
+    }))
+
+def cached_lookup(service, query, lookup):
+    """
+    Returns lookup(query), memoized in S3 under the cache folder so results are
+    shared across Lambda instances. Misses (None) are cached too; exceptions
+    raised by lookup are not.
+    """
+    normalized = " ".join(query.split()).lower()
+    digest = hashlib.sha1(f"{service}:{normalized}".encode("utf-8")).hexdigest()
+    cache_key = f"{CACHE_FOLDER}/geocode/{digest}.json"
 
     try:
-        response = requests.post(
-            url="http://www.geo-locate.org/webservices/geolocatesvcv2/geolocatesvc.asmx",
-            headers={
-                "Content-Type": "text/xml; charset=utf-8",
-                "SOAPAction": "http://geo-locate.org/webservices/Georef2"
-            },
-            data=soap_request
+        cached = s3_client.get_object(Bucket=BUCKET_NAME, Key=cache_key)
+        return json.loads(cached["Body"].read())
+    except s3_client.exceptions.NoSuchKey:
+        pass
+
+    result = lookup(query)
+    try:
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=cache_key,
+            Body=json.dumps(result),
+            ContentType='application/json'
         )
+    except ClientError as e:
+        print(f"Warning: Could not cache {service} lookup for '{query}': {e}")
+    return result
 
-        if response.status_code == 200:
-            root = ElementTree.fromstring(response.content)
-            namespace = {'ns': 'http://geo-locate.org/webservices/'}
-            result_set = root.find('.//ns:ResultSet', namespace)
-            if result_set is not None:
-                coord = result_set.find('ns:WGS84Coordinate', namespace)
-                if coord is not None:
-                    lat = float(coord.find('ns:Latitude', namespace).text)
-                    lon = float(coord.find('ns:Longitude', namespace).text)
-                    precision = result_set.find('ns:Precision', namespace).text
-                    score = int(result_set.find('ns:Score', namespace).text)
-                    uncertainty = result_set.find('ns:UncertaintyRadiusMeters', namespace).text
-                    return {
-                        'latitude': lat,
-                        'longitude': lon,
-                        'precision': precision,
-                        'score': score,
-                        'uncertainty_radius_m': uncertainty
-                    }
-        return None
+def query_geolocate(township_str, country, state):
+    """
+    Calls a SOAP endpoint to convert a township-range string (which must include a section) into lat/lon.
+    Returns None when the service has no match; raises on transport errors.
+    """
+    soap_request = (
+        GEOLOCATE_SOAP_TEMPLATE
+        .replace(b"\x00C\x00", html.escape(country).encode("utf-8"))
+        .replace(b"\x00S\x00", html.escape(state).encode("utf-8"))
+        .replace(b"\x00L\x00", html.escape(township_str).encode("utf-8"))
+    )
+
+    response = http_session.post(
+        url="http://www.geo-locate.org/webservices/geolocatesvcv2/geolocatesvc.asmx",
+        headers={
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": "http://geo-locate.org/webservices/Georef2"
+        },
+        data=soap_request,
+        # (connect, read) timeouts cap the tail latency of a single lookup
+        timeout=(3, 10)
+    )
+    response.raise_for_status()
+
+    root = etree.fromstring(response.content, parser=soap_parser)
+    result_sets = first_result_set(root)
+    if result_sets:
+        result_set = result_sets[0]
+        lat = result_set.findtext('ns:WGS84Coordinate/ns:Latitude', namespaces=GEOLOCATE_NAMESPACES)
+        lon = result_set.findtext('ns:WGS84Coordinate/ns:Longitude', namespaces=GEOLOCATE_NAMESPACES)
+        if lat is not None and lon is not None:
+            return {
+                'latitude': float(lat),
+                'longitude': float(lon),
+                'precision': result_set.findtext('ns:Precision', namespaces=GEOLOCATE_NAMESPACES),
+                'score': int(result_set.findtext('ns:Score', namespaces=GEOLOCATE_NAMESPACES)),
+                'uncertainty_radius_m': result_set.findtext('ns:UncertaintyRadiusMeters', namespaces=GEOLOCATE_NAMESPACES)
+            }
+    return None
+
+def get_coordinates_from_township(township_str, country="United States of America", state="Colorado"):
+    """
+    Converts a township-range string into lat/lon via the GeoLocate service,
+    going through the shared geocode cache.
+    """
+    try:
+        return cached_lookup(
+            "geolocate",
+            f"{country}|{state}|{township_str}",
+            lambda _: query_geolocate(township_str, country, state)
+        )
     except Exception as e:
         print(f"ERROR calling SOAP API for {township_str}. Exception: {e}")
         return None
 
-def upload_to_github(gh_client, repo_name, file_path, content, commit_message):
+def geocode_name(query):
     """
-    Upload (or update) a file in GitHub.
+    Geocodes a place name with Nominatim. Returns None when nothing matches.
     """
-    repo = gh_client.get_user().get_repo(repo_name)
-    try:
-        existing_contents = repo.get_contents(file_path)
-        repo.update_file(file_path, commit_message, content, existing_contents.sha)
-    except Exception:
-        repo.create_file(file_path, commit_message, content)
-    return f"https://github.com/{gh_client.get_user().login}/{repo_name}/blob/main/{file_path}"
+    # Nominatim's usage policy forbids parallel requests
+    with geocode_lock:
+        location = geolocator.geocode(query,country_codes="us")
+    if location:
+        return {
+            'latitude': location.latitude,
+            'longitude': location.longitude
+        }
+    return None
 
-def lambda_handler(event, context):
-    bucket_name = os.environ.get("BUCKET_NAME")
-    error_folder = os.environ.get("ERROR_FOLDER", "error")
-    analysis_folder = os.environ.get("ANALYSIS_FOLDER", "analysis")
+def resolve_water_resource(resource):
+    """
+    Resolves a single water resource to coordinates, trying its township-range
+    first and falling back to geocoding its name.
+    Returns (name, feature_type, township_range, coord, coord_source).
+    """
+    name = resource.get("name", "").strip()
+    feature_type = resource.get("feature_type", "").strip()
+    ts = resource.get("township_range", "").strip()
 
-    github_token = os.environ.get("GITHUB_TOKEN")
-    github_repo_name = os.environ.get("GITHUB_REPO_NAME", "water_resources_geojson")
-    bedrock_model_id = os.environ.get("BEDROCK_MODEL_ID", "anthropic.claude-3-5")
-    bedrock_region = os.environ.get("BEDROCK_REGION", "us-west-2")
+    coord_source = ""
+    coord = None
 
-    prompt_file_name = os.environ.get("PROMPT_FILE_NAME", "prompt.py")
+    if ts:
+        if "Section" not in ts:
+            ts = ts + " Section 15"
+        coord = get_coordinates_from_township(ts)
+        coord_source = f"Township-Range: {ts}" if coord else ""
 
-    # Initialize bedrock client with region
-    bedrock_client = boto3.client("bedrock-runtime", region_name=bedrock_region)
+    if not coord:
+        # Attempt geocoding
+        try:
+            query = ts if ts else name +", Colorado, USA"
 
-    from github import Github
-    gh_client = Github(github_token)
+            if not query:
+                raise ValueError("No township or name to geocode.")
+            coord = cached_lookup("nominatim", query, geocode_name)
+            if coord:
+                coord_source = f"Geocoded from name: {name}"
+        except Exception as geocode_e:
+            print(f"Warning: Could not geocode water resource '{name}': {geocode_e}")
 
-    # Attempt to load the prompt from a local file in the Lambda package
-    # (You might have a better approach, e.g., SSM Parameter, or stored in S3)
-    # from .prompt import PROMPT
-    prompt_text = """Analyze the uploaded map image thoroughly to identify all relevant details. Then, return a strictly formatted JSON object with the **exact** structure and keys below (and nothing else):
+    return name, feature_type, ts, coord, coord_source
 
-{
-  "map_description": "string",
-  "township_range": [
-    // An array of valid township-range strings. A township-range string is considered valid only if it contains:
-    //   1. A Township value in the format "T<number>N" or "T<number>S"
-    //   2. A Range value in the format "R<number>E" or "R<number>W"
-    //   3. Ideally, a Section value formatted as "Section <number>"
-    // For example: "T1N R1E Section 1" or "T2S R3W Section 15".
-    // If you cannot find any complete township-range information, return an empty array.
-  ],
-  "county": "string", 
-    // If multiple counties apply, join them into one string separated by a semicolon and a space (e.g., "Teller County (Colo.); El Paso County (Colo.)").
-  "water_resources": [
-    // An array with as many water resources as you can identify from the map.
-    // For each water resource, include the following keys:
-    {
-      "name": "string",
-      "description": "string",
-      "feature_type": "reservoir, dam, river, lake, creek, etc.",
-      "township_range": "string" 
-        // If you can identify a valid township-range (i.e. including both T and R values, and a Section number), put it here.
-        // Otherwise, leave this field as an empty string "".
-    },
-    ...
-  ]
-}
-
-Instructions and notes:
-1. **map_description**: Provide a comprehensive description of the map, including its features, landmarks, and any notable context.
-2. **township_range**: Only include strings that contain both a valid Township and Range value (e.g., "T8N R70W") along with a Section number (e.g., "Section 15"). Do not include partial entries like "T8N" alone.
-3. **county**: Clearly specify the county (or counties) where the map is located. If more than one county is relevant, separate them using a semicolon and a space.
-4. **water_resources**:
-   - Identify every water resource visible on the map.
-   - For each, include "name", "description", and "feature_type".
-   - If the water resource has a visible township-range that is complete (including T, R), include it in the "township_range" field; if not, use an empty string.
-5. Return **only** valid JSON without any extra commentary, explanations, or text outside of the JSON object.
-"""
-    # try:
-    #     with open(os.path.join(os.path.dirname(__file__), prompt_file_name), "r") as f:
-    #         prompt_text = f.read()
-    # except Exception:
-    #     # fallback to an inline prompt if needed
-    #     prompt_text = """
-    #     Analyze the uploaded map image thoroughly...
-    #     ...
-    #     (Your fallback prompt here)
-    #     """
+@functools.lru_cache(maxsize=1)
+def github_repo_owner():
+    """
+    Returns the owner of the GeoJSON repository: GITHUB_REPO_OWNER if set,
+    otherwise the token's user, looked up once per container.
+    """
+    if GITHUB_REPO_OWNER:
+        return GITHUB_REPO_OWNER
+    response = github_session.get(f"{GITHUB_API_URL}/user", timeout=(3, 10))
+    response.raise_for_status()
+    return response.json()["login"]
 
-    try:
-        record = event['Records'][0]
-        s3_info = record['s3']
-        source_bucket = s3_info['bucket']['name']
-        object_key = s3_info['object']['key']
-        image_name = os.path.basename(object_key)
-
-        local_image_path = f"/tmp/{image_name}"
-        s3_client.download_file(source_bucket, object_key, local_image_path)
-
-        # Convert image to base64
-        with open(local_image_path, "rb") as f:
-            content_image_b64 = base64.b64encode(f.read()).decode("utf-8")
-
-        # Invoke the Bedrock model with the base64 image + prompt
-        llm_response = invoke_bedrock_model_claude_multimodal(
-            bedrock_client=bedrock_client,
-            content_image_b64=content_image_b64,
-            text_prompt=prompt_text,
-            model_id=bedrock_model_id,
-            max_length=2048
-        )
+def upload_to_github(repo_name, file_path, content, commit_message):
+    """
+    Upload (or update) a file in GitHub through the contents API.
+    New files take a single PUT; existing files need their sha, which is only
+    fetched when GitHub rejects the PUT because the file is already there.
+    """
+    contents_url = f"{GITHUB_API_URL}/repos/{github_repo_owner()}/{repo_name}/contents/{quote(file_path)}"
+    payload = {
+        "message": commit_message,
+        "content": base64.b64encode(content.encode("utf-8")).decode("ascii")
+    }
+
+    response = github_session.put(contents_url, json=payload, timeout=(3, 30))
+    if response.status_code == 422:
+        existing = github_session.get(contents_url, timeout=(3, 10))
+        existing.raise_for_status()
+        payload["sha"] = existing.json()["sha"]
+        response = github_session.put(contents_url, json=payload, timeout=(3, 30))
+    response.raise_for_status()
+    return response.json()["content"]["html_url"]
+
+def iter_s3_objects(message):
+    """
+    Yields (bucket, key, sequencer) tuples from an SQS message wrapping an S3
+    event notification. The sequencer is the same for every delivery of one
+    event. S3 test events carry no records and are skipped.
+    """
+    s3_event = json.loads(message["body"])
+    for record in s3_event.get("Records", []):
+        s3_object = record["s3"]["object"]
+        yield record["s3"]["bucket"]["name"], unquote_plus(s3_object["key"]), s3_object.get("sequencer", "")
 
-        parsed_data = json.loads(llm_response)
-        print(parsed_data)
-        map_description = parsed_data.get("map_description", "")
-        map_township_ranges = parsed_data.get("township_range", [])
-        county_str = parsed_data.get("county", "")
-        water_resources = parsed_data.get("water_resources", [])
+def read_image(source_bucket, object_key):
+    """
+    Reads an image straight into memory.
+    """
+    return s3_client.get_object(Bucket=source_bucket, Key=object_key)["Body"].read()
 
-        # Tweak T/R if needed
-        updated_map_township = []
-        for ts in map_township_ranges:
-            if "Section" not in ts:
-                ts = ts.strip() + " Section 15"
-            updated_map_township.append(ts)
+def analyze_image(object_key, image_bytes, sequencer=""):
+    """
+    Runs the full analysis for one compressed image: Bedrock extraction,
+    township/geocoding lookups, GeoJSON upload to GitHub and the CSV row shard.
+    Returns the S3 location of the written shard.
+    """
+    image_name = os.path.basename(object_key)
+
+    # Convert image to base64
+    content_image_b64 = base64.b64encode(image_bytes)
+
+    # Invoke the Bedrock model with the base64 image + prompt
+    llm_response = invoke_bedrock_model_claude_multimodal(
+        bedrock_client=bedrock_client,
+        content_image_b64=content_image_b64,
+        text_prompt=PROMPT_TEXT,
+        model_id=BEDROCK_MODEL_ID,
+        max_length=2048,
+        media_type=IMAGE_MEDIA_TYPES.get(os.path.splitext(image_name)[1].lower(), "image/png")
+    )
+
+    json_text = extract_json(llm_response)
+    if len(json_text) != len(llm_response):
+        # Track how often the prompt fails to keep Claude to bare JSON
+        emit_metric("ModelResponseTrimmed", object_key=object_key, trimmed_chars=len(llm_response) - len(json_text))
+    parsed_data = json.loads(json_text)
+    print(parsed_data)
+    map_description = parsed_data.get("map_description", "")
+    map_township_ranges = parsed_data.get("township_range", [])
+    county_str = parsed_data.get("county", "")
+    water_resources = parsed_data.get("water_resources", [])
+
+    # Tweak T/R if needed
+    updated_map_township = []
+    for ts in map_township_ranges:
+        if "Section" not in ts:
+            ts = ts.strip() + " Section 15"
+        updated_map_township.append(ts)
+
+    # Resolve map-level T/R and water resources concurrently; every lookup is
+    # an independent network call, so wall time is bounded by the slowest one.
+    with ThreadPoolExecutor(max_workers=GEOCODE_MAX_WORKERS) as executor:
+        township_results = executor.map(get_coordinates_from_township, updated_map_township)
+        resolved_resources = executor.map(resolve_water_resource, water_resources)
 
         # Convert T/R to coordinates
         township_coords = []
-        for ts in updated_map_township:
-            coord = get_coordinates_from_township(ts)
+        for ts, coord in zip(updated_map_township, township_results):
             if coord:
                 coord["township_range_reference"] = ts
                 township_coords.append(coord)
 
-        # Water resources
-        water_features = []
-        water_feature_list = []
-        water_resource_coords = []
-
-        for resource in water_resources:
-            name = resource.get("name", "").strip()
-            feature_type = resource.get("feature_type", "").strip()
-            ts = resource.get("township_range", "").strip()
-
-            coord_source = ""
-            coord = None
-
-            if ts:
-                if "Section" not in ts:
-                    ts = ts + " Section 15"
-                coord = get_coordinates_from_township(ts)
-                coord_source = f"Township-Range: {ts}" if coord else ""
-
-            if not coord:
-                # Attempt geocoding
-                try:
-                    query = ts if ts else name +", Colorado, USA"
-                    
-                    if not query:
-                        raise ValueError("No township or name to geocode.")
-                    location = geolocator.geocode(query,country_codes="us")
-                    if location:
-                        coord = {
-                            'latitude': location.latitude,
-                            'longitude': location.longitude
-                        }
-                        coord_source = f"Geocoded from name: {name}"
-                except Exception as geocode_e:
-                    print(f"Warning: Could not geocode water resource '{name}': {geocode_e}")
+        resolved_resources = list(resolved_resources)
 
-            if coord:
-                water_resource_coords.append(coord)
-                point_feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [coord['longitude'], coord['latitude']]
-                    },
-                    "properties": {
-                        "name": name,
-                        "type": feature_type,
-                        "coordinate_source": coord_source,
-                        "township_range_used": ts if ts else ""
-                    }
-                }
-                water_features.append(point_feature)
-                water_feature_list.append(f"{name} ({feature_type})")
-            else:
-                water_feature_list.append(f"{name} ({feature_type})")
-
-        # Compute bounding box
-        all_coords = []
-        if township_coords:
-            all_coords = township_coords
-            bounding_box_source = "Derived from Map-Level Township Ranges"
-        elif water_resource_coords:
-            all_coords = water_resource_coords
-            bounding_box_source = "Fallback from Water Resource Coordinates"
-        else:
-            bounding_box_source = "No coordinates available"
-
-        if all_coords:
-            lats = [c['latitude'] for c in all_coords]
-            lons = [c['longitude'] for c in all_coords]
-            west, east = min(lons), max(lons)
-            south, north = min(lats), max(lats)
-            center_lat = (north + south) / 2
-            center_lon = (west + east) / 2
-            bounding_box_str = f"ENVELOPE({west},{east},{north},{south})"
-            bbox_polygon = [
-                [west, south],
-                [east, south],
-                [east, north],
-                [west, north],
-                [west, south]
-            ]
-        else:
-            center_lat = ""
-            center_lon = ""
-            bounding_box_str = ""
-            bbox_polygon = []
-
-        # Build GeoJSON
-        features = []
-        if bbox_polygon:
-            features.append({
+    # Water resources
+    water_features = []
+    water_feature_list = []
+    water_resource_coords = []
+
+    for name, feature_type, ts, coord, coord_source in resolved_resources:
+        if coord:
+            water_resource_coords.append(coord)
+            point_feature = {
                 "type": "Feature",
                 "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [bbox_polygon]
+                    "type": "Point",
+                    "coordinates": [coord['longitude'], coord['latitude']]
                 },
                 "properties": {
-                    "name": "Map Boundary",
-                    "source": bounding_box_source,
-                    "map_township_ranges_used": updated_map_township
+                    "name": name,
+                    "type": feature_type,
+                    "coordinate_source": coord_source,
+                    "township_range_used": ts if ts else ""
                 }
-            })
-        features.extend(water_features)
-
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": features
-        }
-
-        # Upload the GeoJSON to GitHub
-        geojson_file_name = os.path.splitext(image_name)[0] + ".geojson"
-        gh_url = upload_to_github(
-            gh_client,
-            github_repo_name,
-            geojson_file_name,
-            json.dumps(geojson_data, indent=2),
-            f"Add {geojson_file_name}"
-        )
-
-        # Build CSV row
-        if county_str and water_feature_list:
-            spatial_coverage = county_str + "; " + "; ".join(water_feature_list)
-        elif county_str:
-            spatial_coverage = county_str
-        elif water_feature_list:
-            spatial_coverage = "; ".join(water_feature_list)
+            }
+            water_features.append(point_feature)
+            water_feature_list.append(f"{name} ({feature_type})")
         else:
-            spatial_coverage = ""
-
-        description_csv = ("This item includes: " + ", ".join(water_feature_list) + ".") if water_feature_list else ""
-
-        csv_row = {
-            "Title*": os.path.splitext(image_name)[0],
-            "Alternate Title": "",
-            "Creator*": "",
-            "Contributor": "",
-            "Artist": "",
-            "Author": "",
-            "Composer": "",
-            "Editor": "",
-            "Lyricist": "",
-            "Producer": "",
-            "Publisher": "",
-            "Coverage": map_description,
-            "Spatial Coverage": spatial_coverage,
-            "Temporal Coverage": "",
-            "Latitude": center_lat,
-            "Longitude": center_lon,
-            "Bounding Box": bounding_box_str,
-            "External Reference": gh_url,
-            "Advisor": "",
-            "Committee Member": "",
-            "Degree Name": "",
-            "Degree Level": "",
-            "Department": "",
-            "University": "",
-            "Date*": "",
-            "Date Created": "",
-            "Date Issued": "",
-            "Date Recorded": "",
-            "Date Submitted": "",
-            "Date Search*": "",
-            "Description": description_csv,
-            "Abstract": "",
-            "Award": "",
-            "Frequency": "",
-            "Sponsorship": "",
-            "Table of Contents": "",
-            "Subject": "",
-            "LCSH Subject*": "",
-            "Language": "",
-            "Language-ISO": "",
-            "Format": "",
-            "Medium*": "",
-            "Extent": "",
-            "Type*": "",
-            "Source": "",
-            "Digital Collection*": "",
-            "Physical Collection*": "",
-            "Series/Location*": "",
-            "Subcollection": "",
-            "Repository*": "",
-            "Rights*": "",
-            "Rights Note": "",
-            "Rights License": "",
-            "Rights URI": "",
-            "Rights DPLA*": "",
-            "Identifier": "",
-            "Citation": "",
-            "DOI": "",
-            "ISBN": "",
-            "URI": "",
-            "Related Resource*": "",
-            "Relation-Has Format Of": "",
-            "Relation-Has Part": "",
-            "Relation-Has Version": "",
-            "Relation-Is Format Of": "",
-            "Relation-Is Referenced By": "",
-            "Relation-Is Replaced By": "",
-            "Relation-Is Version Of": "",
-            "Relation-References": "",
-            "Relation-Replaces": "",
-            "Transcript": "",
-            "Path": "",
-            "File Name": image_name
-        }
-        
-
-        # Append or create CSV in S3
-        analysis_csv_key = f"{analysis_folder}/dublin core metadata analysis file.csv"
-        try:
-            existing_obj = s3_client.get_object(Bucket=bucket_name, Key=analysis_csv_key)
-            existing_csv = existing_obj["Body"].read().decode("utf-8")
-            df_existing = pd.read_csv(io.StringIO(existing_csv))
-            df_new = pd.DataFrame([csv_row])
-            df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-        except s3_client.exceptions.NoSuchKey:
-            df_combined = pd.DataFrame([csv_row])
-        except Exception as e:
-            print(f"Error reading existing CSV file: {e}. Creating a new one.")
-            df_combined = pd.DataFrame([csv_row])
-
-        csv_buffer = io.StringIO()
-        df_combined.to_csv(csv_buffer, index=False)
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=analysis_csv_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
-        )
+            water_feature_list.append(f"{name} ({feature_type})")
+
+    # Compute bounding box
+    all_coords = []
+    if township_coords:
+        all_coords = township_coords
+        bounding_box_source = "Derived from Map-Level Township Ranges"
+    elif water_resource_coords:
+        all_coords = water_resource_coords
+        bounding_box_source = "Fallback from Water Resource Coordinates"
+    else:
+        bounding_box_source = "No coordinates available"
+
+    if all_coords:
+        lats = [c['latitude'] for c in all_coords]
+        lons = [c['longitude'] for c in all_coords]
+        west, east = min(lons), max(lons)
+        south, north = min(lats), max(lats)
+        center_lat = (north + south) / 2
+        center_lon = (west + east) / 2
+        bounding_box_str = f"ENVELOPE({west},{east},{north},{south})"
+        bbox_polygon = [
+            [west, south],
+            [east, south],
+            [east, north],
+            [west, north],
+            [west, south]
+        ]
+    else:
+        center_lat = ""
+        center_lon = ""
+        bounding_box_str = ""
+        bbox_polygon = []
+
+    # Build GeoJSON
+    features = []
+    if bbox_polygon:
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [bbox_polygon]
+            },
+            "properties": {
+                "name": "Map Boundary",
+                "source": bounding_box_source,
+                "map_township_ranges_used": updated_map_township
+            }
+        })
+    features.extend(water_features)
+
+    geojson_data = {
+        "type": "FeatureCollection",
+        "features": features
+    }
+
+    # Upload the GeoJSON to GitHub
+    geojson_file_name = os.path.splitext(image_name)[0] + ".geojson"
+    gh_url = upload_to_github(
+        GITHUB_REPO_NAME,
+        geojson_file_name,
+        json.dumps(geojson_data, indent=2),
+        f"Add {geojson_file_name}"
+    )
+
+    # Build CSV row
+    if county_str and water_feature_list:
+        spatial_coverage = county_str + "; " + "; ".join(water_feature_list)
+    elif county_str:
+        spatial_coverage = county_str
+    elif water_feature_list:
+        spatial_coverage = "; ".join(water_feature_list)
+    else:
+        spatial_coverage = ""
+
+    description_csv = ("This item includes: " + ", ".join(water_feature_list) + ".") if water_feature_list else ""
+
+    csv_row = {
+        "Title*": os.path.splitext(image_name)[0],
+        "Alternate Title": "",
+        "Creator*": "",
+        "Contributor": "",
+        "Artist": "",
+        "Author": "",
+        "Composer": "",
+        "Editor": "",
+        "Lyricist": "",
+        "Producer": "",
+        "Publisher": "",
+        "Coverage": map_description,
+        "Spatial Coverage": spatial_coverage,
+        "Temporal Coverage": "",
+        "Latitude": center_lat,
+        "Longitude": center_lon,
+        "Bounding Box": bounding_box_str,
+        "External Reference": gh_url,
+        "Advisor": "",
+        "Committee Member": "",
+        "Degree Name": "",
+        "Degree Level": "",
+        "Department": "",
+        "University": "",
+        "Date*": "",
+        "Date Created": "",
+        "Date Issued": "",
+        "Date Recorded": "",
+        "Date Submitted": "",
+        "Date Search*": "",
+        "Description": description_csv,
+        "Abstract": "",
+        "Award": "",
+        "Frequency": "",
+        "Sponsorship": "",
+        "Table of Contents": "",
+        "Subject": "",
+        "LCSH Subject*": "",
+        "Language": "",
+        "Language-ISO": "",
+        "Format": "",
+        "Medium*": "",
+        "Extent": "",
+        "Type*": "",
+        "Source": "",
+        "Digital Collection*": "",
+        "Physical Collection*": "",
+        "Series/Location*": "",
+        "Subcollection": "",
+        "Repository*": "",
+        "Rights*": "",
+        "Rights Note": "",
+        "Rights License": "",
+        "Rights URI": "",
+        "Rights DPLA*": "",
+        "Identifier": "",
+        "Citation": "",
+        "DOI": "",
+        "ISBN": "",
+        "URI": "",
+        "Related Resource*": "",
+        "Relation-Has Format Of": "",
+        "Relation-Has Part": "",
+        "Relation-Has Version": "",
+        "Relation-Is Format Of": "",
+        "Relation-Is Referenced By": "",
+        "Relation-Is Replaced By": "",
+        "Relation-Is Version Of": "",
+        "Relation-References": "",
+        "Relation-Replaces": "",
+        "Transcript": "",
+        "Path": "",
+        "File Name": image_name
+    }
+
+
+    # Write this row as its own shard; the compaction Lambda merges shards into
+    # the consolidated CSV on a schedule. The key is derived from the S3 event,
+    # so a redelivery of the same event overwrites its shard instead of adding a row.
+    shard_id = hashlib.sha1(f"{object_key}:{sequencer}".encode("utf-8")).hexdigest()
+    shard_key = f"{ANALYSIS_FOLDER}/shards/{shard_id}.jsonl"
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=shard_key,
+        Body=json.dumps(csv_row) + "\n",
+        ContentType='application/x-ndjson'
+    )
+
+    return f"s3://{BUCKET_NAME}/{shard_key}"
+
+def is_terminal_error(error):
+    """
+    Returns True for failures that will not go away on retry (missing object,
+    rejected request, missing permissions, a 4xx other than 429 from GitHub or
+    the geocoders, model output with no parseable JSON).
+    """
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in TERMINAL_ERROR_CODES
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and 400 <= status < 500 and status != 429
+    # extract_json / json.loads (JSONDecodeError is a ValueError)
+    return isinstance(error, ValueError)
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": "Analysis completed successfully.",
-                "csv_location": f"s3://{bucket_name}/{analysis_csv_key}"
-            })
-        }
+def lambda_handler(event, context):
+    """
+    Triggered by SQS batches of S3 events on the 'compressed/' folder.
+    Analyzes each image. Transient failures (throttling, network errors) are
+    reported back to SQS so they are retried and eventually dead-lettered;
+    terminal failures (see is_terminal_error) are written to the 'error/'
+    folder and acknowledged.
+    """
+    objects = [
+        (message["messageId"], source_bucket, object_key, sequencer)
+        for message in event.get("Records", [])
+        for source_bucket, object_key, sequencer in iter_s3_objects(message)
+    ]
 
-    except Exception as e:
-        error_message = f"Error processing image '{object_key}': {str(e)}"
-        print(error_message)
-        error_file_name = f"{os.path.splitext(os.path.basename(object_key))[0]}.txt"
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=f"{error_folder}/{error_file_name}",
-            Body=error_message
-        )
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": error_message})
-        }
+    batch_item_failures = []
+    failed_message_ids = set()
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_image = prefetcher.submit(read_image, *objects[0][1:3]) if objects else None
+        for i, (message_id, source_bucket, object_key, sequencer) in enumerate(objects):
+            image_future = next_image
+            # Download the next image while this one is being analyzed
+            next_image = prefetcher.submit(read_image, *objects[i + 1][1:3]) if i + 1 < len(objects) else None
+
+            if message_id in failed_message_ids:
+                continue
+            try:
+                shard_location = analyze_image(object_key, image_future.result(), sequencer)
+                print(f"Analysis completed for '{object_key}': {shard_location}")
+            except Exception as e:
+                terminal = is_terminal_error(e)
+                print(json.dumps({
+                    "level": "error",
+                    "key": object_key,
+                    "err": str(e),
+                    "type": type(e).__name__,
+                    "terminal": terminal
+                }))
+                if terminal:
+                    # Retrying won't help: leave a note in 'error/' and acknowledge the message
+                    error_file_name = f"{os.path.splitext(os.path.basename(object_key))[0]}.txt"
+                    s3_client.put_object(
+                        Bucket=BUCKET_NAME,
+                        Key=f"{ERROR_FOLDER}/{error_file_name}",
+                        Body=f"Error processing image '{object_key}': {str(e)}"
+                    )
+                    continue
+                # Let SQS redeliver the message (and eventually dead-letter it)
+                failed_message_ids.add(message_id)
+                batch_item_failures.append({"itemIdentifier": message_id})
+
+    return {"batchItemFailures": batch_item_failures}
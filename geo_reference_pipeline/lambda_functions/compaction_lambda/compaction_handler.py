@@ -0,0 +1,181 @@
+import os
+import io
+import csv
+import itertools
+import json
+import boto3
+
+s3_client = boto3.client("s3")
+
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+# Rows with the same value in this column describe the same image; the newest wins
+DEDUPE_COLUMN = "File Name"
+
+
+def list_shards(bucket_name, shard_prefix):
+    """
+    Lists every JSONL shard under the shard prefix as (key, etag) pairs, oldest
+    first, so rows are appended to the consolidated CSV in roughly the order
+    they were analyzed and a newer row for the same image wins.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    shards = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=shard_prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".jsonl"):
+                shards.append((obj["LastModified"], obj["Key"], obj["ETag"]))
+    shards.sort()
+    return [(key, etag) for _, key, etag in shards]
+
+def read_undeleted_shards(bucket_name, undeleted_key):
+    """
+    Returns {key: etag} for shards an earlier run merged but failed to delete.
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket_name, Key=undeleted_key)["Body"].read()
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(body)
+
+def write_undeleted_shards(bucket_name, undeleted_key, undeleted):
+    """
+    Records merged shards that are still in the bucket so the next run doesn't
+    merge them again, or clears the record once there are none.
+    """
+    if undeleted:
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=undeleted_key,
+            Body=json.dumps(undeleted),
+            ContentType="application/json"
+        )
+    else:
+        s3_client.delete_object(Bucket=bucket_name, Key=undeleted_key)
+
+def read_shard_rows(bucket_name, shard_keys):
+    """
+    Reads the given shards and returns their rows as a list of dicts.
+    """
+    rows = []
+    for key in shard_keys:
+        body = s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read().decode("utf-8")
+        rows.extend(json.loads(line) for line in body.splitlines() if line.strip())
+    return rows
+
+def merge_rows_into_csv(existing_csv, rows):
+    """
+    Appends rows to an existing CSV document (or starts a new one) and returns
+    the merged CSV text. Columns that first appear in the new rows are added
+    at the end; missing values are written as empty strings. A row whose
+    DEDUPE_COLUMN matches an earlier row replaces it in place.
+    """
+    fieldnames = []
+    existing_rows = []
+    if existing_csv:
+        reader = csv.DictReader(io.StringIO(existing_csv))
+        fieldnames = list(reader.fieldnames or [])
+        existing_rows = reader
+
+    seen = set(fieldnames)
+    for row in rows:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                fieldnames.append(key)
+
+    merged_rows = []
+    row_index = {}
+    for row in itertools.chain(existing_rows, rows):
+        name = row.get(DEDUPE_COLUMN)
+        if name and name in row_index:
+            merged_rows[row_index[name]] = row
+            continue
+        if name:
+            row_index[name] = len(merged_rows)
+        merged_rows.append(row)
+
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames, restval="", lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(merged_rows)
+    return csv_buffer.getvalue()
+
+def delete_shards(bucket_name, shard_keys):
+    """
+    Deletes merged shards in batches and returns the keys S3 failed to delete.
+    Quiet mode only reports failures, so they have to be read from the response.
+    """
+    failed_keys = []
+    for i in range(0, len(shard_keys), DELETE_BATCH_SIZE):
+        batch = shard_keys[i:i + DELETE_BATCH_SIZE]
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+        )
+        for error in response.get("Errors", []):
+            print(f"Failed to delete shard {error['Key']}: {error.get('Code')} {error.get('Message')}")
+            failed_keys.append(error["Key"])
+    return failed_keys
+
+def lambda_handler(event, context):
+    """
+    Triggered on a schedule by EventBridge.
+    Merges the per-image shards written by the analysis Lambda into the
+    consolidated Dublin Core CSV under the 'analysis/' folder, then deletes them.
+    """
+    bucket_name = os.environ.get("BUCKET_NAME")
+    analysis_folder = os.environ.get("ANALYSIS_FOLDER", "analysis")
+
+    shard_prefix = f"{analysis_folder}/shards/"
+    analysis_csv_key = f"{analysis_folder}/dublin core metadata analysis file.csv"
+    undeleted_key = f"{shard_prefix}undeleted.json"
+
+    shards = list_shards(bucket_name, shard_prefix)
+    undeleted = read_undeleted_shards(bucket_name, undeleted_key)
+    # Shards already merged by an earlier run are only deleted again; one that
+    # was rewritten since has a new ETag and is merged like any other
+    shard_keys = [key for key, etag in shards if undeleted.get(key) != etag]
+    merged_keys = [key for key, etag in shards if undeleted.get(key) == etag]
+
+    if shard_keys:
+        rows = read_shard_rows(bucket_name, shard_keys)
+
+        try:
+            existing_obj = s3_client.get_object(Bucket=bucket_name, Key=analysis_csv_key)
+            existing_csv = existing_obj["Body"].read().decode("utf-8")
+        except s3_client.exceptions.NoSuchKey:
+            existing_csv = ""
+
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=analysis_csv_key,
+            Body=merge_rows_into_csv(existing_csv, rows),
+            ContentType='text/csv'
+        )
+
+    # Only remove shards once the consolidated CSV has been written; any that
+    # can't be deleted are recorded so the next run doesn't merge them again
+    failed_keys = delete_shards(bucket_name, merged_keys + shard_keys)
+    etags = dict(shards)
+    if failed_keys or undeleted:
+        write_undeleted_shards(bucket_name, undeleted_key, {key: etags[key] for key in failed_keys})
+
+    if not shard_keys:
+        print("No shards to compact.")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "No shards to compact.", "merged_shards": 0})
+        }
+
+    print(f"Merged {len(shard_keys)} shards into s3://{bucket_name}/{analysis_csv_key}")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "Compaction completed successfully.",
+            "merged_shards": len(shard_keys),
+            "undeleted_shards": len(failed_keys),
+            "csv_location": f"s3://{bucket_name}/{analysis_csv_key}"
+        })
+    }
@@ -2,124 +2,541 @@ import os
 import io
 import json
 import math
+import zlib
 import logging
+import tempfile
+import multiprocessing
 import boto3
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from urllib.parse import unquote_plus
+from PIL import Image, ImageChops
+
+try:
+    # Shipped in layer1; without it every TIFF is decoded by Pillow
+    import numpy
+    import tifffile
+except ImportError:
+    tifffile = None
 
 Image.MAX_IMAGE_PIXELS = None  # Potential caution in production
 
-s3_client = boto3.client('s3')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+COMPRESSED_FOLDER = os.environ.get("COMPRESSED_FOLDER", "compressed")
+ERROR_FOLDER = os.environ.get("ERROR_FOLDER", "error")
+TARGET_SIZE_MB = float(os.environ.get("COMPRESSION_TARGET_MB", "3"))
+# Memory set aside per worker process: a fully decoded 20k x 20k scan is
+# ~1.2 GB before the probe pyramid and the resized copy
+WORKER_MEMORY_MB = 3072
 
-def optimize_image_size(img, target_size_mb, initial_scale=1.0):
+def worker_process_count():
     """
-    Optimize the image size by binary searching for the optimal scaling factor
-    so that the saved PNG meets the target size in megabytes.
+    Number of worker processes per batch: COMPRESSION_WORKER_PROCESSES, where
+    0 means one per vCPU and 1 (the default) disables worker processes,
+    capped at one per WORKER_MEMORY_MB of the function's memory.
     """
-    target_bytes = target_size_mb * 1024 * 1024
+    processes = int(os.environ.get("COMPRESSION_WORKER_PROCESSES", "1")) or os.cpu_count() or 1
+    memory_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "0"))
+    if memory_mb:
+        processes = min(processes, max(1, memory_mb // WORKER_MEMORY_MB))
+    return processes
+
+WORKER_PROCESSES = worker_process_count()
+
+# Source extensions the Lambda converts
+_TIFF_SUFFIXES = ('.tif', '.tiff')
+
+# The pipelined download and upload each run up to max_concurrency ranged
+# requests at once, more than botocore's default pool of 10 connections
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True
+)
+s3_client = boto3.client('s3', config=S3_CLIENT_CONFIG)
+
+# Large objects are transferred as parallel ranged GETs / multipart uploads
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+# S3's minimum multipart part size; smaller outputs are sent as one PUT
+MULTIPART_MIN_BYTES = 5 * 1024 * 1024
+
+# Output format for converted images: "PNG" (lossless) or "WEBP" (lossy, far
+# smaller for photographic scans so more resolution fits under the target)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "PNG").upper()
+OUTPUT_EXTENSIONS = {"PNG": ".png", "WEBP": ".webp"}
+if OUTPUT_FORMAT not in OUTPUT_EXTENSIONS:
+    # Fail at init rather than on every record of every batch
+    raise ValueError(f"Unsupported OUTPUT_FORMAT {OUTPUT_FORMAT!r}, expected one of {sorted(OUTPUT_EXTENSIONS)}")
+# Claude rejects images wider or taller than this (WebP's own limit is 16383)
+MAX_OUTPUT_DIMENSION = 8000
+# Modes written to PNG without conversion (grayscale also makes a smaller PNG)
+PNG_NATIVE_MODES = ('RGB', 'L')
+# Downloads up to this size stay in memory; larger TIFFs spill to /tmp
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+# Conservative compressed/raw size ratio of a photographic PNG / WebP
+SIZE_RATIO_ESTIMATES = {"PNG": 0.55, "WEBP": 0.15}
+# Scale search bounds for optimize_image_size
+MIN_SCALE = 0.1
+MAX_SCALE_PROBES = 3
+# Final resizes may box-reduce first while staying this many times above the
+# output size; from 3.0 up Pillow's result is indistinguishable from plain LANCZOS
+FINAL_REDUCING_GAP = 3.0
+# Probe sizes are measured on one strip of rows out of every PROBE_STRIP_STRIDE
+PROBE_STRIP_ROWS = 32
+PROBE_STRIP_STRIDE = 4
+# Side in pixels of the tile used to calibrate fast probe encodes
+CALIBRATION_TILE_SIZE = 512
+# Settings for every PNG that is kept or used for calibration. Level 6 without
+# optimize is several times faster than level 9 with it; output is up to ~20%
+# larger, which the scale search absorbs.
+PNG_SAVE_OPTIONS = {"optimize": False, "compress_level": 6}
+# WebP "method" (0-6) trades encode speed for size like the zlib level does
+WEBP_SAVE_OPTIONS = {"quality": 85, "method": 4}
+# Final encodes tried before giving up on hitting the target exactly
+FINAL_ENCODE_ATTEMPTS = 3
+
+def open_image_tifffile(input_stream):
+    """
+    Decodes plain 8-bit, pixel-interleaved RGB or grayscale TIFFs with
+    tifffile. Single-band pixels larger than SPOOL_MAX_BYTES are decoded into a
+    memmap under /tmp rather than the heap (Image.fromarray shares an "L"
+    buffer but copies RGB, so RGB always decodes to the heap). Returns None for
+    anything else (palette, CMYK, 16-bit, band-interleaved, or a compression
+    tifffile can't decode without imagecodecs) so Pillow handles it.
+    """
+    input_stream.seek(0)
+    try:
+        # A spooled file has no usable .name (None in memory, an fd on disk),
+        # which tifffile needs, so give it one
+        with tifffile.TiffFile(input_stream, name="source.tif") as tif:
+            page = tif.pages[0]
+            if page.dtype != numpy.uint8 or page.photometric not in (
+                tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.MINISBLACK
+            ) or page.planarconfig != tifffile.PLANARCONFIG.CONTIG:
+                return None
+            if page.samplesperpixel == 1 and page.nbytes > SPOOL_MAX_BYTES:
+                # Not out="memmap": that maps uncompressed pixels straight from
+                # the source file, which is truncated once the image is decoded
+                with tempfile.TemporaryFile() as memmap_file:
+                    arr = page.asarray(out=memmap_file)
+            else:
+                arr = page.asarray()
+    except Exception as e:
+        logger.info("tifffile could not decode the image, falling back to Pillow: %s", e)
+        return None
+
+    # Drop alpha / extra samples the same way convert('RGB') would
+    if arr.ndim == 3:
+        arr = arr[..., :3] if page.photometric == tifffile.PHOTOMETRIC.RGB else arr[..., 0]
+    return Image.fromarray(numpy.ascontiguousarray(arr))
+
+def open_image(input_stream, target_bytes=None):
+    """
+    Decodes the TIFF and returns it in a mode PNG can store directly. When a
+    conversion is needed the source image is closed straight away, so its
+    decoded pixels aren't held alongside the converted copy.
+
+    Given target_bytes, formats that can decode at reduced resolution (JPEG
+    data saved under a .tif name) are decoded at no less than twice the
+    estimated output size; for real TIFFs Pillow's draft() is a no-op.
+    """
+    if tifffile is not None:
+        img = open_image_tifffile(input_stream)
+        if img is not None:
+            return img
+
+    input_stream.seek(0)
+    source = Image.open(input_stream)
+    if target_bytes:
+        est_bytes = estimate_output_bytes(source.width, source.height, len(source.getbands()))
+        draft_scale = min(2 * math.sqrt(target_bytes / est_bytes), 1.0)
+        if draft_scale < 0.5:
+            source.draft(source.mode, (int(source.width * draft_scale), int(source.height * draft_scale)))
+    # RGB and grayscale scans are encoded as-is; everything else becomes RGB
+    if source.mode in PNG_NATIVE_MODES:
+        source.load()
+        return source
+    with source:
+        return source.convert('RGB')
+
+def estimate_output_bytes(width, height, bands):
+    """
+    Rough output size for a full-resolution encode, used to pick a starting
+    scale without encoding. Compressible scans come out far smaller; the scale
+    search grows the scale back towards 1.0 when its probes show that.
+    """
+    return width * height * bands * SIZE_RATIO_ESTIMATES[OUTPUT_FORMAT]
+
+def max_output_scale(width, height):
+    """
+    Largest scale that keeps both sides within MAX_OUTPUT_DIMENSION, so the
+    analysis Lambda can send the output to Claude.
+    """
+    return min(1.0, MAX_OUTPUT_DIMENSION / max(width, height))
+
+def save_image(img, buffer):
+    """
+    Encodes img into buffer in the configured output format.
+    """
+    if OUTPUT_FORMAT == "WEBP":
+        img.save(buffer, format='WEBP', **WEBP_SAVE_OPTIONS)
+    else:
+        img.save(buffer, format='PNG', **PNG_SAVE_OPTIONS)
+
+def probe_png_bytes(img):
+    """
+    Cheap stand-in for an encode: applies the PNG "sub" row filter with
+    ImageChops and deflates the result at level 1. Only every
+    PROBE_STRIP_STRIDE-th strip of PROBE_STRIP_ROWS rows is compressed and
+    the total is extrapolated from the rows sampled.
+    """
+    sampled_bytes = 0
+    sampled_rows = 0
+    for top in range(0, img.height, PROBE_STRIP_ROWS * PROBE_STRIP_STRIDE):
+        strip = img.crop((0, top, img.width, min(top + PROBE_STRIP_ROWS, img.height)))
+        filtered = ImageChops.subtract_modulo(strip, ImageChops.offset(strip, 1, 0))
+        sampled_bytes += len(zlib.compress(filtered.tobytes(), 1))
+        sampled_rows += strip.height
+    return sampled_bytes * img.height / sampled_rows
+
+def probe_calibration(img, scale):
+    """
+    Returns final-encode size / probe size measured on a center tile resampled
+    at the given scale. The probe misjudges smooth and noisy scans in opposite
+    directions (and knows nothing about WebP), so probe sizes are multiplied
+    by this ratio.
+    """
+    side = min(int(CALIBRATION_TILE_SIZE / scale), img.width, img.height)
+    left = (img.width - side) // 2
+    top = (img.height - side) // 2
+    tile_side = max(1, int(side * scale))
+    tile = img.crop((left, top, left + side, top + side)).resize((tile_side, tile_side), Image.LANCZOS)
+
     buffer = io.BytesIO()
-    low, high = 0.1, 1.0
-    best_img = None
+    save_image(tile, buffer)
+    return buffer.tell() / probe_png_bytes(tile)
 
-    for _ in range(8):
-        mid = (low + high) / 2
-        new_width = int(img.width * mid)
-        new_height = int(img.height * mid)
-        resized = img.resize((new_width, new_height), Image.LANCZOS)
+def mip_for_size(mips, size):
+    """
+    Returns the smallest level of the pyramid that is still at least twice
+    the requested size. The pyramid starts as [img] and is extended with
+    reduce(2) halvings only as far as a probe needs.
+    """
+    while mips[-1].width >= 4 * size[0] and mips[-1].height >= 4 * size[1]:
+        mips.append(mips[-1].reduce(2))
+    for mip in reversed(mips):
+        if mip.width >= 2 * size[0] and mip.height >= 2 * size[1]:
+            return mip
+    return mips[0]
 
-        buffer.seek(0)
-        buffer.truncate()
-        resized.save(buffer, format='PNG', optimize=True, compress_level=9)
-        current_size = buffer.tell()
+def optimize_image_size(img, target_size_mb, initial_scale=1.0, max_scale=1.0):
+    """
+    Finds the largest scaling factor (up to max_scale) whose encoded output
+    stays within the target size in megabytes and returns the resized (not yet
+    encoded) image.
+
+    Encoded size grows roughly with pixel count (size ~ k * scale^2), so each probe
+    refits k from the measured size and jumps straight to the scale the model
+    predicts, usually settling within two or three probes.
+
+    Probes are sized with probe_png_bytes and corrected by the ratio
+    probe_calibration measures; the caller still checks the final encode.
+    """
+    target_bytes = target_size_mb * 1024 * 1024
+    scale = min(max(initial_scale, MIN_SCALE), max_scale)
+    calibration = probe_calibration(img, scale)
+    # Probes resample from a cached mip pyramid, the final resize from the original
+    mips = [img]
+    best_scale = None
+
+    for _ in range(MAX_SCALE_PROBES):
+        new_width = max(1, int(img.width * scale))
+        new_height = max(1, int(img.height * scale))
+        resized = mip_for_size(mips, (new_width, new_height)).resize((new_width, new_height), Image.LANCZOS)
+        current_size = probe_png_bytes(resized) * calibration
 
         if current_size <= target_bytes:
-            best_img = resized
-            low = mid
-        else:
-            high = mid
+            best_scale = max(best_scale or 0.0, scale)
+            if current_size >= target_bytes * 0.9 or scale >= max_scale:
+                break
+
+        # size ~ k * scale^2  =>  the scale that hits the target, minus a safety margin
+        k = current_size / (scale * scale)
+        scale = min(max(math.sqrt(target_bytes / k) * 0.97, MIN_SCALE), max_scale)
 
-    return best_img or img
+    # Nothing measured fits yet: use the last prediction and let the final encode check it
+    best_scale = best_scale or scale
+    if best_scale >= 1.0:
+        return img
+    # Release the pyramid before the final full-quality resize
+    del mips
+    return img.resize(
+        (max(1, int(img.width * best_scale)), max(1, int(img.height * best_scale))),
+        Image.LANCZOS,
+        reducing_gap=FINAL_REDUCING_GAP
+    )
 
 def convert_tiff_to_png_stream(input_stream, target_size_mb=3):
     """
-    Converts a TIFF image (provided as an in-memory stream) to a PNG,
-    compressing/resizing it so that the final file is at or below the target size.
+    Converts a TIFF image (provided as an in-memory stream) to a PNG (or WebP
+    when OUTPUT_FORMAT is "WEBP"), compressing/resizing it so that the final
+    file is at or below the target size.
+    The input stream is emptied once the image has been decoded.
     """
     try:
+        img = open_image(input_stream, target_size_mb * 1024 * 1024)
+        # The decoded image is all that's needed from here on; release the source bytes
         input_stream.seek(0)
-        with Image.open(input_stream) as img:
-            img = img.convert('RGB')
-            
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG', optimize=True, compress_level=9)
+        input_stream.truncate()
+
+        # One output buffer, reused by the size check and the final encodes
+        buffer = io.BytesIO()
+
+        # Only pay for a full-resolution encode when the image plausibly fits already
+        max_scale = max_output_scale(img.width, img.height)
+        initial_size_mb = estimate_output_bytes(img.width, img.height, len(img.getbands())) / (1024 * 1024)
+        if initial_size_mb <= target_size_mb * 1.1 and max_scale >= 1.0:
+            save_image(img, buffer)
             initial_size_mb = buffer.tell() / (1024 * 1024)
 
             if initial_size_mb <= target_size_mb:
                 buffer.seek(0)
                 return buffer, initial_size_mb, (img.width, img.height)
 
-            scale_estimate = math.sqrt(target_size_mb / initial_size_mb)
-            optimized_img = optimize_image_size(img, target_size_mb, scale_estimate)
+        scale_estimate = math.sqrt(target_size_mb / initial_size_mb)
+        optimized_img = optimize_image_size(img, target_size_mb, scale_estimate, max_scale)
 
-            final_buffer = io.BytesIO()
-            optimized_img.save(final_buffer, format='PNG', optimize=True, compress_level=9)
-            final_size_mb = final_buffer.tell() / (1024 * 1024)
+        for _ in range(FINAL_ENCODE_ATTEMPTS):
+            buffer.seek(0)
+            buffer.truncate()
+            save_image(optimized_img, buffer)
+            final_size_mb = buffer.tell() / (1024 * 1024)
+            if final_size_mb <= target_size_mb:
+                break
+            # The fast probes underestimated this image; shrink to what the measured size predicts
+            shrink = math.sqrt(target_size_mb / final_size_mb) * 0.97
+            optimized_img = img.resize(
+                (max(1, int(optimized_img.width * shrink)), max(1, int(optimized_img.height * shrink))),
+                Image.LANCZOS
+            )
+        buffer.seek(0)
 
-            return final_buffer, final_size_mb, (optimized_img.width, optimized_img.height)
+        return buffer, final_size_mb, (optimized_img.width, optimized_img.height)
     except Exception as e:
-        logging.error(f"Error in convert_tiff_to_png_stream: {e}")
+        logger.error("Error in convert_tiff_to_png_stream: %s", e)
         raise
 
-def lambda_handler(event, context):
+def download_to_spool(bucket, key):
     """
-    Triggered by S3 events on the 'raw/' folder.
-    Downloads the file, converts to PNG under the 'compressed/' folder,
-    writes errors to 'error/' folder if any exceptions occur.
+    Downloads an S3 object into a spooled temporary file and returns it rewound.
+    TIFF decoding needs random access, so the object can't be decoded straight
+    from the response body, but large files no longer have to fit in memory.
     """
-    bucket_name = os.environ.get("BUCKET_NAME")
-    compressed_folder = os.environ.get("COMPRESSED_FOLDER", "compressed")
-    error_folder = os.environ.get("ERROR_FOLDER", "error")
-    target_size_mb = float(os.environ.get("COMPRESSION_TARGET_MB", "3"))
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        s3_client.download_fileobj(bucket, key, spool, Config=TRANSFER_CONFIG)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
 
-    logging.info("Event: %s", json.dumps(event))
+def iter_s3_objects(message):
+    """
+    Yields (bucket, key) pairs from an SQS message wrapping an S3 event notification.
+    S3 test events carry no records and are skipped.
+    """
+    s3_event = json.loads(message["body"])
+    for record in s3_event.get("Records", []):
+        yield record["s3"]["bucket"]["name"], unquote_plus(record["s3"]["object"]["key"])
 
-    for record in event.get('Records', []):
-        obj = record['s3']
-        source_bucket = obj['bucket']['name']
-        source_key = obj['object']['key']
+def upload_png(converted_stream, bucket_name, object_key, image_size_mb, dimensions):
+    """
+    Uploads a converted image stream to S3. Outputs below the minimum part size
+    go up as a single PUT straight from the buffer, skipping the transfer
+    manager's threads and chunk copies; larger ones use a multipart upload.
+    """
+    converted_stream.seek(0)
+    if converted_stream.getbuffer().nbytes < MULTIPART_MIN_BYTES:
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=converted_stream)
+    else:
+        s3_client.upload_fileobj(converted_stream, bucket_name, object_key, Config=TRANSFER_CONFIG)
+    logger.info(
+        "Uploaded compressed file to s3://%s/%s | Size: %.2f MB | Dimensions: %dx%d",
+        bucket_name, object_key, image_size_mb, dimensions[0], dimensions[1]
+    )
 
-        # Only process .tif or .tiff
-        if not source_key.lower().endswith(('.tif', '.tiff')):
-            logging.info(f"Skipping non-TIFF file: {source_key}")
-            continue
+def convert_record(source_bucket, source_key, bucket_name, object_key, target_size_mb):
+    """
+    Downloads, converts and uploads a single TIFF.
+    """
+    with download_to_spool(source_bucket, source_key) as original_stream:
+        converted_stream, image_size_mb, dimensions = convert_tiff_to_png_stream(
+            original_stream,
+            target_size_mb=target_size_mb
+        )
+    upload_png(converted_stream, bucket_name, object_key, image_size_mb, dimensions)
 
-        file_basename = os.path.splitext(os.path.basename(source_key))[0]
-        new_object_key = f"{compressed_folder}/{file_basename}.png"
+def record_worker(conn, *args):
+    """
+    Entry point of a worker process. boto3 clients are not safe to share
+    across a fork, so the worker gets its own before converting the record;
+    it sends back None on success or the error message.
+    """
+    global s3_client
+    s3_client = boto3.client('s3', config=S3_CLIENT_CONFIG)
+    try:
+        convert_record(*args)
+        conn.send(None)
+    except Exception as e:
+        conn.send(str(e))
+    finally:
+        conn.close()
 
-        try:
-            # Download the original TIFF
-            original_stream = io.BytesIO()
-            s3_client.download_fileobj(source_bucket, source_key, original_stream)
-
-            # Convert to compressed PNG
-            converted_stream, image_size_mb, dimensions = convert_tiff_to_png_stream(
-                original_stream,
-                target_size_mb=target_size_mb
-            )
+def run_worker_processes(jobs, max_processes, skip_job=None):
+    """
+    Runs convert_record for each (job_id, args) in its own process, at most
+    max_processes at a time, and yields (job_id, error) as workers finish.
+    Jobs for which skip_job(job_id) is true by the time they would start are
+    dropped. Uses Process + Pipe because multiprocessing.Pool needs /dev/shm,
+    which Lambda doesn't provide.
+    """
+    pending = list(reversed(jobs))
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_processes:
+            job_id, args = pending.pop()
+            if skip_job is not None and skip_job(job_id):
+                continue
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=record_worker, args=(writer, *args))
+            process.start()
+            writer.close()
+            running[reader] = (job_id, process)
 
-            # Upload the converted file
-            converted_stream.seek(0)
-            s3_client.upload_fileobj(converted_stream, bucket_name, new_object_key)
-            logging.info(
-                f"Uploaded compressed file to s3://{bucket_name}/{new_object_key} | "
-                f"Size: {image_size_mb:.2f} MB | Dimensions: {dimensions[0]}x{dimensions[1]}"
-            )
+        # Every remaining job was skipped; wait() on no connections never returns
+        if not running:
+            break
+
+        for reader in wait(list(running)):
+            job_id, process = running.pop(reader)
+            try:
+                error = reader.recv()
+            except EOFError:
+                # The worker died before reporting back (e.g. out of memory)
+                process.join()
+                error = f"Worker process exited with code {process.exitcode}"
+            reader.close()
+            process.join()
+            yield job_id, error
+
+def lambda_handler(event, context):
+    """
+    Triggered by SQS batches of S3 events on the 'raw/' folder.
+    Downloads each file, converts to PNG under the 'compressed/' folder,
+    writes errors to 'error/' folder if any exceptions occur and reports
+    failed messages back to SQS so they are retried.
+
+    With several vCPUs, records are converted in parallel worker processes.
+    Otherwise they are pipelined: the next TIFF downloads and the previous
+    PNG uploads while the current one is being converted.
+    """
+    # The event is only formatted when debug logging is enabled
+    logger.debug("Event: %s", event)
+
+    objects = []
+    for message in event.get('Records', []):
+        for source_bucket, source_key in iter_s3_objects(message):
+            # Only process .tif or .tiff
+            if not source_key.lower().endswith(_TIFF_SUFFIXES):
+                logger.info("Skipping non-TIFF file: %s", source_key)
+                continue
+            logger.info("processing s3://%s/%s", source_bucket, source_key)
+            file_basename = os.path.splitext(os.path.basename(source_key))[0]
+            new_object_key = f"{COMPRESSED_FOLDER}/{file_basename}{OUTPUT_EXTENSIONS[OUTPUT_FORMAT]}"
+            objects.append((message["messageId"], source_bucket, source_key, new_object_key))
+
+    batch_item_failures = []
+    failed_message_ids = set()
 
+    def record_failure(message_id, source_key, error):
+        error_message = f"Error processing file {source_key}: {error}"
+        logger.error(error_message)
+        error_file_name = f"{os.path.splitext(os.path.basename(source_key))[0]}.txt"
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=f"{ERROR_FOLDER}/{error_file_name}",
+            Body=error_message
+        )
+        # Let SQS redeliver the message (and eventually dead-letter it)
+        if message_id not in failed_message_ids:
+            failed_message_ids.add(message_id)
+            batch_item_failures.append({"itemIdentifier": message_id})
+
+    def finish_upload(pending):
+        if pending is None:
+            return
+        message_id, source_key, upload_future = pending
+        try:
+            upload_future.result()
         except Exception as e:
-            error_message = f"Error processing file {source_key}: {e}"
-            logging.error(error_message)
-            error_file_name = f"{file_basename}.txt"
-            s3_client.put_object(
-                Bucket=bucket_name,
-                Key=f"{error_folder}/{error_file_name}",
-                Body=error_message
-            )
+            record_failure(message_id, source_key, e)
+
+    if WORKER_PROCESSES > 1 and len(objects) > 1:
+        jobs = [
+            (i, (source_bucket, source_key, BUCKET_NAME, new_object_key, TARGET_SIZE_MB))
+            for i, (_, source_bucket, source_key, new_object_key) in enumerate(objects)
+        ]
+        # Records of a message that already failed are redelivered anyway
+        def skip_job(i):
+            return objects[i][0] in failed_message_ids
+
+        for i, error in run_worker_processes(jobs, WORKER_PROCESSES, skip_job):
+            if error is not None:
+                record_failure(objects[i][0], objects[i][2], error)
+        return {"batchItemFailures": batch_item_failures}
+
+    with ThreadPoolExecutor(max_workers=1) as downloader, ThreadPoolExecutor(max_workers=1) as uploader:
+        next_download = downloader.submit(download_to_spool, *objects[0][1:3]) if objects else None
+        pending_upload = None
+        for i, (message_id, source_bucket, source_key, new_object_key) in enumerate(objects):
+            download_future = next_download
+            next_download = downloader.submit(download_to_spool, *objects[i + 1][1:3]) if i + 1 < len(objects) else None
+
+            if message_id in failed_message_ids:
+                # The message is redelivered anyway; release the prefetched spool
+                try:
+                    download_future.result().close()
+                except Exception:
+                    pass
+                continue
+
+            try:
+                # Convert the downloaded TIFF to a compressed PNG
+                with download_future.result() as original_stream:
+                    converted_stream, image_size_mb, dimensions = convert_tiff_to_png_stream(
+                        original_stream,
+                        target_size_mb=TARGET_SIZE_MB
+                    )
+            except Exception as e:
+                record_failure(message_id, source_key, e)
+                continue
+
+            # Wait for the previous upload so at most one PNG is held in memory
+            finish_upload(pending_upload)
+            pending_upload = (message_id, source_key, uploader.submit(
+                upload_png, converted_stream, BUCKET_NAME, new_object_key, image_size_mb, dimensions
+            ))
+        finish_upload(pending_upload)
+
+    return {"batchItemFailures": batch_item_failures}
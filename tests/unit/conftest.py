@@ -0,0 +1,12 @@
+import os
+import sys
+
+LAMBDA_FUNCTIONS = os.path.join(os.path.dirname(__file__), "..", "..", "geo_reference_pipeline", "lambda_functions")
+
+# The handlers are deployed as top-level modules, one directory per Lambda
+for lambda_dir in ("compress_lambda", "analysis_lambda", "compaction_lambda"):
+    sys.path.insert(0, os.path.abspath(os.path.join(LAMBDA_FUNCTIONS, lambda_dir)))
+
+# Module-level boto3 clients need a region; nothing in the tests reaches AWS
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+os.environ.setdefault("BUCKET_NAME", "test-bucket")
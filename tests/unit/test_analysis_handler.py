@@ -0,0 +1,185 @@
+import io
+import json
+
+import pytest
+import requests
+from botocore.exceptions import ClientError
+
+import analysis_handler
+
+
+class FakeS3:
+    """Keeps objects in a dict and raises the real client's NoSuchKey."""
+
+    exceptions = analysis_handler.s3_client.exceptions
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key].encode("utf-8"))}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(response=self)
+
+
+class FakeGitHub:
+    """Answers PUTs from a queue of responses and records every call."""
+
+    def __init__(self, put_responses, get_response=None):
+        self.put_responses = list(put_responses)
+        self.get_response = get_response
+        self.calls = []
+
+    def put(self, url, json=None, timeout=None):
+        self.calls.append(("PUT", url, dict(json)))
+        return self.put_responses.pop(0)
+
+    def get(self, url, timeout=None):
+        self.calls.append(("GET", url, None))
+        return self.get_response
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(analysis_handler, "s3_client", fake)
+    return fake
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"county": "Weld"}', '{"county": "Weld"}'),
+    ('Here is the JSON:\n{"county": "Weld"}\nLet me know!', '{"county": "Weld"}'),
+    ('{"a": {"b": [1, 2]}} {"c": 3}', '{"a": {"b": [1, 2]}}'),
+    ('{"note": "braces } and \\" quotes {"}', '{"note": "braces } and \\" quotes {"}'),
+], ids=["bare", "prose", "nested", "braces-in-strings"])
+def test_extract_json_returns_first_object(text, expected):
+    assert analysis_handler.extract_json(text) == expected
+
+
+def test_extract_json_returns_unclosed_remainder():
+    text = 'Sure: {"county": "Weld"'
+
+    assert analysis_handler.extract_json(text) == '{"county": "Weld"'
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(analysis_handler.extract_json(text))
+
+
+def test_extract_json_without_object_is_terminal():
+    with pytest.raises(ValueError) as excinfo:
+        analysis_handler.extract_json("I could not read this map.")
+
+    assert analysis_handler.is_terminal_error(excinfo.value)
+
+
+def test_cached_lookup_stores_and_reuses_results(s3):
+    calls = []
+
+    def lookup(query):
+        calls.append(query)
+        return [40.0, -105.0]
+
+    first = analysis_handler.cached_lookup("nominatim", "Boulder  Creek", lookup)
+    # Queries are normalized before being hashed into the cache key
+    second = analysis_handler.cached_lookup("nominatim", "boulder creek", lookup)
+
+    assert first == second == [40.0, -105.0]
+    assert calls == ["Boulder  Creek"]
+    assert all(key.startswith(f"{analysis_handler.CACHE_FOLDER}/geocode/") for key in s3.objects)
+
+
+def test_cached_lookup_caches_misses_but_not_exceptions(s3):
+    calls = []
+
+    def miss(query):
+        calls.append(query)
+        return None
+
+    def broken(query):
+        raise requests.ConnectionError("geocoder unavailable")
+
+    assert analysis_handler.cached_lookup("geolocate", "T1N R69W", miss) is None
+    assert analysis_handler.cached_lookup("geolocate", "T1N R69W", miss) is None
+    assert calls == ["T1N R69W"]
+
+    with pytest.raises(requests.ConnectionError):
+        analysis_handler.cached_lookup("geolocate", "T2N R69W", broken)
+    assert len(s3.objects) == 1
+
+
+def test_upload_to_github_creates_new_file_in_one_put(monkeypatch):
+    github = FakeGitHub([FakeResponse(201, {"content": {"html_url": "https://github.com/o/r/blob/main/a.geojson"}})])
+    monkeypatch.setattr(analysis_handler, "github_session", github)
+    monkeypatch.setattr(analysis_handler, "GITHUB_REPO_OWNER", "o")
+
+    url = analysis_handler.upload_to_github("r", "a.geojson", "{}", "Add a.geojson")
+
+    assert url == "https://github.com/o/r/blob/main/a.geojson"
+    assert [(method, "sha" in (payload or {})) for method, _, payload in github.calls] == [("PUT", False)]
+
+
+def test_upload_to_github_fetches_sha_when_file_exists(monkeypatch):
+    github = FakeGitHub(
+        [
+            FakeResponse(422, {"message": "\"sha\" wasn't supplied."}),
+            FakeResponse(200, {"content": {"html_url": "https://github.com/o/r/blob/main/a b.geojson"}})
+        ],
+        get_response=FakeResponse(200, {"sha": "abc123"})
+    )
+    monkeypatch.setattr(analysis_handler, "github_session", github)
+    monkeypatch.setattr(analysis_handler, "GITHUB_REPO_OWNER", "o")
+
+    url = analysis_handler.upload_to_github("r", "a b.geojson", "{}", "Update a b.geojson")
+
+    assert url == "https://github.com/o/r/blob/main/a b.geojson"
+    assert [method for method, _, _ in github.calls] == ["PUT", "GET", "PUT"]
+    assert github.calls[2][2]["sha"] == "abc123"
+    assert all(call_url.endswith("/repos/o/r/contents/a%20b.geojson") for _, call_url, _ in github.calls)
+
+
+def test_upload_to_github_raises_when_sha_lookup_fails(monkeypatch):
+    github = FakeGitHub([FakeResponse(422)], get_response=FakeResponse(404))
+    monkeypatch.setattr(analysis_handler, "github_session", github)
+    monkeypatch.setattr(analysis_handler, "GITHUB_REPO_OWNER", "o")
+
+    with pytest.raises(requests.HTTPError) as excinfo:
+        analysis_handler.upload_to_github("r", "a.geojson", "{}", "Update a.geojson")
+
+    assert analysis_handler.is_terminal_error(excinfo.value)
+
+
+@pytest.mark.parametrize("error, terminal", [
+    (ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject"), True),
+    (ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeModel"), False),
+    (requests.HTTPError(response=FakeResponse(401)), True),
+    (requests.HTTPError(response=FakeResponse(429)), False),
+    (requests.HTTPError(response=FakeResponse(502)), False),
+    (requests.HTTPError(), False),
+    (requests.ConnectionError(), False),
+    (ValueError("No JSON object found in model response."), True),
+])
+def test_is_terminal_error(error, terminal):
+    assert analysis_handler.is_terminal_error(error) is terminal
+
+
+def test_iter_s3_objects_decodes_keys_and_keeps_sequencer():
+    message = {"body": json.dumps({"Records": [
+        {"s3": {"bucket": {"name": "b"}, "object": {"key": "compressed/map+one.png", "sequencer": "0A1B"}}}
+    ]})}
+
+    assert list(analysis_handler.iter_s3_objects(message)) == [("b", "compressed/map one.png", "0A1B")]
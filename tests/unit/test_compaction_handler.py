@@ -0,0 +1,151 @@
+import csv
+import datetime
+import io
+import json
+
+import pytest
+
+import compaction_handler
+
+SHARD_PREFIX = "analysis/shards/"
+CSV_KEY = "analysis/dublin core metadata analysis file.csv"
+UNDELETED_KEY = f"{SHARD_PREFIX}undeleted.json"
+
+
+class FakeS3:
+    """
+    Keeps objects in a dict with an ETag and upload order; keys in
+    undeletable come back in delete_objects' Errors like an AccessDenied.
+    """
+
+    exceptions = compaction_handler.s3_client.exceptions
+
+    def __init__(self):
+        self.objects = {}
+        self.undeletable = set()
+        self.clock = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.clock += 1
+        etag = f'"{self.clock}"'
+        self.objects[Key] = (Body, etag, datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=self.clock))
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key][0].encode("utf-8"))}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        errors = []
+        for item in Delete["Objects"]:
+            if item["Key"] in self.undeletable:
+                errors.append({"Key": item["Key"], "Code": "AccessDenied", "Message": "Access Denied"})
+            else:
+                self.objects.pop(item["Key"], None)
+        return {"Errors": errors} if errors else {}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {"Contents": [
+            {"Key": key, "ETag": etag, "LastModified": modified}
+            for key, (_, etag, modified) in self.objects.items() if key.startswith(Prefix)
+        ]}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(compaction_handler, "s3_client", fake)
+    monkeypatch.setenv("BUCKET_NAME", "test-bucket")
+    monkeypatch.delenv("ANALYSIS_FOLDER", raising=False)
+    return fake
+
+
+def write_shard(s3, name, row):
+    s3.put_object(Bucket="test-bucket", Key=f"{SHARD_PREFIX}{name}.jsonl", Body=json.dumps(row) + "\n")
+
+
+def csv_rows(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def test_merge_rows_into_csv_starts_new_document():
+    merged = compaction_handler.merge_rows_into_csv("", [{"Title": "A", "File Name": "a.png"}])
+
+    assert merged == "Title,File Name\nA,a.png\n"
+
+
+def test_merge_rows_into_csv_appends_new_columns():
+    existing = "Title,File Name\nA,a.png\n"
+
+    merged = compaction_handler.merge_rows_into_csv(existing, [{"Title": "B", "Coverage": "Weld", "File Name": "b.png"}])
+
+    assert merged.splitlines()[0] == "Title,File Name,Coverage"
+    assert csv_rows(merged) == [
+        {"Title": "A", "File Name": "a.png", "Coverage": ""},
+        {"Title": "B", "File Name": "b.png", "Coverage": "Weld"}
+    ]
+
+
+def test_merge_rows_into_csv_replaces_rows_for_same_file_name():
+    existing = "Title,File Name\nA,a.png\nB,b.png\n"
+
+    merged = compaction_handler.merge_rows_into_csv(existing, [
+        {"Title": "A2", "File Name": "a.png"},
+        {"Title": "C", "File Name": "c.png"},
+        {"Title": "A3", "File Name": "a.png"}
+    ])
+
+    assert [(row["Title"], row["File Name"]) for row in csv_rows(merged)] == [
+        ("A3", "a.png"), ("B", "b.png"), ("C", "c.png")
+    ]
+
+
+def test_delete_shards_returns_failed_keys(s3):
+    write_shard(s3, "a", {})
+    write_shard(s3, "b", {})
+    s3.undeletable.add(f"{SHARD_PREFIX}b.jsonl")
+
+    failed = compaction_handler.delete_shards("test-bucket", [f"{SHARD_PREFIX}a.jsonl", f"{SHARD_PREFIX}b.jsonl"])
+
+    assert failed == [f"{SHARD_PREFIX}b.jsonl"]
+    assert list(s3.objects) == [f"{SHARD_PREFIX}b.jsonl"]
+
+
+def test_undeleted_shard_is_not_merged_twice(s3):
+    write_shard(s3, "a", {"Title": "A", "File Name": "a.png"})
+    write_shard(s3, "b", {"Title": "B", "File Name": "b.png"})
+    s3.undeletable.add(f"{SHARD_PREFIX}b.jsonl")
+
+    first = json.loads(compaction_handler.lambda_handler({}, None)["body"])
+    assert (first["merged_shards"], first["undeleted_shards"]) == (2, 1)
+    assert list(json.loads(s3.objects[UNDELETED_KEY][0])) == [f"{SHARD_PREFIX}b.jsonl"]
+
+    # The CSV was edited in between; a second merge of b would overwrite it
+    s3.put_object(Bucket="test-bucket", Key=CSV_KEY, Body="Title,File Name\nA,a.png\nB (edited),b.png\n")
+    s3.undeletable.clear()
+
+    second = json.loads(compaction_handler.lambda_handler({}, None)["body"])
+    assert second["merged_shards"] == 0
+    assert set(s3.objects) == {CSV_KEY}
+    assert [row["Title"] for row in csv_rows(s3.objects[CSV_KEY][0])] == ["A", "B (edited)"]
+
+
+def test_rewritten_undeleted_shard_is_merged_again(s3):
+    write_shard(s3, "b", {"Title": "B", "File Name": "b.png"})
+    s3.undeletable.add(f"{SHARD_PREFIX}b.jsonl")
+    compaction_handler.lambda_handler({}, None)
+
+    # A redelivered analysis rewrites the shard, which gives it a new ETag
+    write_shard(s3, "b", {"Title": "B2", "File Name": "b.png"})
+    s3.undeletable.clear()
+
+    body = json.loads(compaction_handler.lambda_handler({}, None)["body"])
+    assert body["merged_shards"] == 1
+    assert set(s3.objects) == {CSV_KEY}
+    assert [row["Title"] for row in csv_rows(s3.objects[CSV_KEY][0])] == ["B2"]
@@ -0,0 +1,223 @@
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import compression_handler
+
+needs_tifffile = pytest.mark.skipif(compression_handler.tifffile is None, reason="tifffile not installed")
+
+
+class FakeS3:
+    """Serves downloads from a dict and records uploads."""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def download_fileobj(self, bucket, key, fileobj, Config=None):
+        fileobj.write(self.objects[key])
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body if isinstance(Body, (bytes, str)) else Body.read()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(compression_handler, "s3_client", fake)
+    return fake
+
+
+@pytest.fixture
+def tifffile_decodes(monkeypatch):
+    """Records what open_image_tifffile returned, as (mode, size) or None."""
+    results = []
+    original = compression_handler.open_image_tifffile
+
+    def spy(input_stream):
+        img = original(input_stream)
+        results.append(None if img is None else (img.mode, img.size))
+        return img
+
+    monkeypatch.setattr(compression_handler, "open_image_tifffile", spy)
+    return results
+
+
+def tiff_bytes(array, **kwargs):
+    buffer = io.BytesIO()
+    compression_handler.tifffile.imwrite(buffer, array, **kwargs)
+    return buffer.getvalue()
+
+
+def convert_from_s3(key, target_size_mb=3):
+    with compression_handler.download_to_spool("bucket", key) as spool:
+        return compression_handler.convert_tiff_to_png_stream(spool, target_size_mb=target_size_mb)
+
+
+@needs_tifffile
+@pytest.mark.parametrize("spool_max_bytes", [64 * 1024 * 1024, 1024], ids=["in-memory", "rolled-to-disk"])
+def test_tifffile_decodes_spooled_rgb(s3, tifffile_decodes, monkeypatch, spool_max_bytes):
+    numpy = compression_handler.numpy
+    monkeypatch.setattr(compression_handler, "SPOOL_MAX_BYTES", spool_max_bytes)
+    pixels = numpy.random.default_rng(0).integers(0, 255, (90, 120, 3), dtype=numpy.uint8)
+    s3.objects["raw/map.tif"] = tiff_bytes(pixels, photometric="rgb")
+
+    _, _, dimensions = convert_from_s3("raw/map.tif")
+
+    assert tifffile_decodes == [("RGB", (120, 90))]
+    assert dimensions == (120, 90)
+
+
+@needs_tifffile
+def test_band_interleaved_tiff_falls_back_to_pillow(s3, tifffile_decodes):
+    numpy = compression_handler.numpy
+    pixels = numpy.random.default_rng(0).integers(0, 255, (3, 90, 120), dtype=numpy.uint8)
+    s3.objects["raw/map.tif"] = tiff_bytes(pixels, photometric="rgb", planarconfig="separate")
+
+    _, _, dimensions = convert_from_s3("raw/map.tif")
+
+    assert tifffile_decodes == [None]
+    assert dimensions == (120, 90)
+
+
+@needs_tifffile
+def test_large_grayscale_memmap_survives_source_truncation(s3, tifffile_decodes, monkeypatch):
+    numpy = compression_handler.numpy
+    # Small enough that both the spool and the memmap go to disk
+    monkeypatch.setattr(compression_handler, "SPOOL_MAX_BYTES", 1024)
+    pixels = numpy.random.default_rng(0).integers(0, 255, (200, 300), dtype=numpy.uint8)
+    s3.objects["raw/map.tif"] = tiff_bytes(pixels, photometric="minisblack")
+
+    converted, _, dimensions = convert_from_s3("raw/map.tif")
+
+    assert tifffile_decodes == [("L", (300, 200))]
+    assert dimensions == (300, 200)
+    assert numpy.array_equal(numpy.asarray(Image.open(converted)), pixels)
+
+
+def test_output_is_capped_at_max_dimension():
+    # Smooth enough to fit the target at full size
+    img = Image.linear_gradient("L").resize((9000, 100))
+    source = io.BytesIO()
+    img.save(source, format="TIFF")
+
+    _, _, (width, _) = compression_handler.convert_tiff_to_png_stream(source, target_size_mb=3)
+
+    assert 7990 <= width <= compression_handler.MAX_OUTPUT_DIMENSION
+
+
+def noise_image(size):
+    return Image.effect_noise(size, 60).convert("RGB")
+
+
+def png_size(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.tell()
+
+
+def test_probe_png_bytes_tracks_encoded_size():
+    smooth = Image.linear_gradient("L").resize((1024, 1024)).convert("RGB")
+    noisy = noise_image((1024, 1024))
+
+    assert compression_handler.probe_png_bytes(smooth) < compression_handler.probe_png_bytes(noisy)
+    # Calibration corrects the rest, but the probe has to be in the right range
+    assert 0.5 < compression_handler.probe_png_bytes(noisy) / png_size(noisy) < 2
+
+
+def test_optimize_image_size_fits_target():
+    img = noise_image((1500, 1500))
+
+    resized = compression_handler.optimize_image_size(img, target_size_mb=1)
+
+    assert resized.width < img.width
+    assert png_size(resized) <= 1.1 * 1024 * 1024
+
+
+def test_optimize_image_size_keeps_image_that_fits():
+    img = noise_image((200, 200))
+
+    assert compression_handler.optimize_image_size(img, target_size_mb=3) is img
+
+
+@pytest.mark.parametrize("size", [(8, 60000), (60000, 8)], ids=["tall", "wide"])
+def test_thin_image_is_never_resized_to_zero_pixels(size):
+    source = io.BytesIO()
+    noise_image(size).save(source, format="TIFF")
+
+    _, _, (width, height) = compression_handler.convert_tiff_to_png_stream(source, target_size_mb=0.05)
+
+    assert width >= 1 and height >= 1
+
+
+def fake_convert_record(source_bucket, source_key, bucket_name, object_key, target_size_mb):
+    if source_key == "raw/broken.tif":
+        raise ValueError("cannot identify image file")
+    if source_key == "raw/oom.tif":
+        # Killed without reporting back, like Lambda's OOM killer
+        os._exit(137)
+
+
+def test_run_worker_processes_reports_each_job(monkeypatch):
+    monkeypatch.setattr(compression_handler, "convert_record", fake_convert_record)
+    jobs = [(i, ("bucket", key, "bucket", "compressed/out.png", 3))
+            for i, key in enumerate(["raw/a.tif", "raw/broken.tif", "raw/oom.tif", "raw/b.tif"])]
+
+    results = dict(compression_handler.run_worker_processes(jobs, max_processes=2))
+
+    assert results == {
+        0: None,
+        1: "cannot identify image file",
+        2: "Worker process exited with code 137",
+        3: None
+    }
+
+
+def test_run_worker_processes_skips_jobs_of_failed_messages(monkeypatch):
+    monkeypatch.setattr(compression_handler, "convert_record", fake_convert_record)
+    jobs = [(i, ("bucket", key, "bucket", "compressed/out.png", 3))
+            for i, key in enumerate(["raw/broken.tif", "raw/a.tif", "raw/b.tif"])]
+    failed = set()
+
+    results = []
+    for job_id, error in compression_handler.run_worker_processes(jobs, max_processes=1, skip_job=failed.__contains__):
+        results.append((job_id, error))
+        if error is not None:
+            failed.update({1, 2})
+
+    assert results == [(0, "cannot identify image file")]
+
+
+def sqs_message(message_id, *keys):
+    records = [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": key}}} for key in keys]
+    return {"messageId": message_id, "body": json.dumps({"Records": records})}
+
+
+def test_records_of_failed_message_are_skipped_and_spools_closed(s3, monkeypatch):
+    source = io.BytesIO()
+    noise_image((64, 64)).save(source, format="TIFF")
+    s3.objects["raw/broken.tif"] = b"not a tiff"
+    s3.objects["raw/ok.tif"] = source.getvalue()
+    s3.objects["raw/other.tif"] = source.getvalue()
+    spools = []
+    original = compression_handler.download_to_spool
+
+    def spy(bucket, key):
+        spool = original(bucket, key)
+        spools.append((key, spool))
+        return spool
+
+    monkeypatch.setattr(compression_handler, "download_to_spool", spy)
+    event = {"Records": [sqs_message("m0", "raw/broken.tif", "raw/ok.tif"), sqs_message("m1", "raw/other.tif")]}
+
+    result = compression_handler.lambda_handler(event, None)
+
+    assert result == {"batchItemFailures": [{"itemIdentifier": "m0"}]}
+    assert "compressed/ok.png" not in s3.objects
+    assert "compressed/other.png" in s3.objects
+    assert "error/broken.txt" in s3.objects
+    assert [(key, spool.closed) for key, spool in spools] == [
+        ("raw/broken.tif", True), ("raw/ok.tif", True), ("raw/other.tif", True)
+    ]
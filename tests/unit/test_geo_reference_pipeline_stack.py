@@ -1,8 +1,18 @@
+import pytest
 import aws_cdk as core
 import aws_cdk.assertions as assertions
 
 from geo_reference_pipeline.geo_reference_pipeline_stack import GeoReferencePipelineStack
 
+
+@pytest.fixture(scope="module")
+def template():
+    # Synthesizing the stack takes seconds, so tests on the defaults share one
+    app = core.App()
+    stack = GeoReferencePipelineStack(app, "geo-reference-pipeline")
+    return assertions.Template.from_stack(stack)
+
+
 # example tests. To run these tests, uncomment this file along with the example
 # resource in geo_reference_pipeline/geo_reference_pipeline_stack.py
 def test_sqs_queue_created():
@@ -13,3 +23,85 @@ def test_sqs_queue_created():
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+def test_compaction_lambda_scheduled(template):
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "compaction_handler.lambda_handler",
+        "ReservedConcurrentExecutions": 1
+    })
+    template.has_resource_properties("AWS::Events::Rule", {
+        "ScheduleExpression": "rate(15 minutes)"
+    })
+
+
+def test_s3_events_batched_through_sqs(template):
+    template.resource_count_is("AWS::SQS::Queue", 4)
+    template.resource_count_is("AWS::Lambda::EventSourceMapping", 2)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 10,
+        "MaximumBatchingWindowInSeconds": 30,
+        "FunctionResponseTypes": ["ReportBatchItemFailures"]
+    })
+
+
+def test_lambdas_run_on_arm64(template):
+    functions = template.find_resources("AWS::Lambda::Function", {
+        "Properties": {"Architectures": ["arm64"]}
+    })
+    assert len(functions) == 3
+    layers = template.find_resources("AWS::Lambda::LayerVersion", {
+        "Properties": {"CompatibleArchitectures": ["arm64"]}
+    })
+    assert len(layers) == 2
+
+
+def test_analysis_alias_has_provisioned_concurrency(template):
+    template.has_resource_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": 1}
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "MinCapacity": 1,
+        "MaxCapacity": 10
+    })
+
+
+def test_zero_context_values_are_kept():
+    app = core.App(context={
+        "analysis_provisioned_concurrency_min": 0,
+        "sqs_max_batching_window_seconds": 0
+    })
+    stack = GeoReferencePipelineStack(app, "geo-reference-pipeline")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": assertions.Match.absent()
+    })
+    template.resource_count_is("AWS::ApplicationAutoScaling::ScalableTarget", 0)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "MaximumBatchingWindowInSeconds": 0
+    })
+
+
+def test_unsupported_output_format_rejected():
+    app = core.App(context={"compression_output_format": "JPEG"})
+    with pytest.raises(ValueError):
+        GeoReferencePipelineStack(app, "geo-reference-pipeline")
+
+
+def test_folders_created_by_single_deployment(template):
+    template.resource_count_is("Custom::CDKBucketDeployment", 1)
+    template.has_resource_properties("Custom::CDKBucketDeployment", {
+        "Prune": False
+    })
+
+
+def test_functions_traced_with_own_roles(template):
+    traced = template.find_resources("AWS::Lambda::Function", {
+        "Properties": {"TracingConfig": {"Mode": "Active"}}
+    })
+    assert len(traced) == 3
+    roles = {fn["Properties"]["Role"]["Fn::GetAtt"][0] for fn in traced.values()}
+    assert len(roles) == 3